@@ -1,12 +1,24 @@
 from __future__ import absolute_import
 
-from .formats import load, save, FORMATS
-import imaging.fft as fft
-import imaging.filters as filters
-import imaging.drawing as drawing
-import imaging.detection as detection
+import importlib
+import importlib.util
+
+from .formats import load, save, register, FORMATS
+
+
+def submodule(package, name):
+    '''
+    imports a submodule of a package on first access, so importing the
+    package does not pull in fftw, cv2, scipy or numba until they are used
+    '''
+    if name.startswith('_') or importlib.util.find_spec(package + '.' + name) is None:
+        raise AttributeError('module {package!r} has no attribute {name!r}'.format(package=package, name=name))
+    return importlib.import_module(package + '.' + name)
+
+
+def __getattr__(name):
+    return submodule(__name__, name)
 
 
 def rgba(r, g, b, a=1.0):
     return (b, g, r, a)
-
@@ -0,0 +1,216 @@
+from __future__ import absolute_import
+
+import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from imaging import fft
+from imaging.formats import FORMATS
+
+
+@lru_cache(maxsize=8)
+def weights(shape, apix, bfactor, lines=1):
+    '''
+    weights of a cross correlation of the real transforms of `shape` frames.
+    the exp(-B s^2 / 4) blur of the frame and of the reference makes an
+    exp(-B s^2 / 2) envelope, and the central `lines` rows and columns are
+    masked so fixed pattern noise on the detector does not pull every frame
+    towards zero shift
+    '''
+    rows, cols = fft.frequencies(tuple(shape))
+    spacing = (rows[:, np.newaxis] ** 2 + cols[np.newaxis, :] ** 2) / np.float32(apix * apix)
+    weights = np.exp(np.float32(-bfactor / 2.0) * spacing).astype('f4')
+    if lines > 0:
+        weights[:lines] = 0.0
+        weights[len(weights) - lines + 1:] = 0.0
+        weights[:, :lines] = 0.0
+    weights.flags.writeable = False
+    return weights
+
+
+def parabola(before, peak, after):
+    '''
+    offset of the vertex of the parabola through three equally spaced values
+    '''
+    curvature = before - 2 * peak + after
+    return np.where(curvature < 0, 0.5 * (before - after) / np.where(curvature < 0, curvature, 1), 0.0)
+
+
+def peaks(cc, radius):
+    '''
+    subpixel (rows, cols) positions of the highest point of each cross
+    correlation in an (N, H, W) stack within `radius` pixels of the origin,
+    refined by a parabola through its neighbours along each axis
+    '''
+    count, height, width = cc.shape
+    radius = int(min(radius, (height - 1) // 2, (width - 1) // 2))
+    rows = np.arange(-radius, radius + 1) % height
+    cols = np.arange(-radius, radius + 1) % width
+    window = cc[:, rows[:, np.newaxis], cols[np.newaxis, :]]
+    size = 2 * radius + 1
+    best = np.argmax(window.reshape(count, -1), axis=1)
+    row, col = best // size, best % size
+    frames = np.arange(count)
+    inner_row = np.clip(row, 1, size - 2)
+    inner_col = np.clip(col, 1, size - 2)
+    drow = parabola(window[frames, inner_row - 1, col], window[frames, inner_row, col],
+                    window[frames, inner_row + 1, col])
+    dcol = parabola(window[frames, row, inner_col - 1], window[frames, row, inner_col],
+                    window[frames, row, inner_col + 1])
+    drow = np.where(inner_row == row, drow, 0.0)
+    dcol = np.where(inner_col == col, dcol, 0.0)
+    return np.stack([row - radius + drow, col - radius + dcol], axis=1).astype('f4')
+
+
+class Aligner(object):
+
+    '''
+    global alignment of the frames of a movie on the CPU.  every frame is
+    transformed once, then each iteration sums the shifted transforms and
+    cross correlates every frame against that sum less its own contribution,
+    moving it to the subpixel peak.  iterations stop once no frame moves by
+    more than `threshold` angstroms.  frames are transformed and correlated
+    `batch` at a time across a thread pool
+    '''
+
+    def __init__(self, apix=1.0, bfactor=1500.0, iterations=10, max_shift=50.0,
+                 threshold=0.1, lines=1, batch=4, gain=None, threads=None):
+        self.apix = float(apix)
+        self.bfactor = float(bfactor)
+        self.iterations = iterations
+        self.max_shift = max_shift
+        self.threshold = threshold
+        self.lines = lines
+        self.batch = batch
+        self.gain = gain
+        self.threads = threads or os.cpu_count()
+        self.ffts = None
+        self.shape = None
+        self.shifts = None
+
+    def batches(self):
+        return range(0, len(self.ffts), self.batch)
+
+    def transform(self, stack, pool):
+        '''
+        real transforms of every frame, gain corrected first when there is a gain
+        '''
+        count, self.shape = len(stack), tuple(stack.shape[-2:])
+        self.ffts = np.empty((count, self.shape[0], self.shape[1] // 2 + 1), dtype='c8')
+
+        def transform_batch(start):
+            stop = min(start + self.batch, count)
+            frames = stack[start:stop]
+            if self.gain is not None:
+                frames = self.gain.apply(frames)
+            self.ffts[start:stop] = fft.rfftn(np.asarray(frames, dtype='f4'), axes=(-2, -1), threads=1)
+
+        list(pool.map(transform_batch, self.batches()))
+        return self.ffts
+
+    def shifted(self, start, shifts):
+        rows, cols = fft.phase_ramps(self.shape, shifts[start:start + self.batch])
+        return self.ffts[start:start + self.batch] * rows * cols
+
+    def total(self, shifts, pool):
+        '''
+        transform of the sum of the frames at the given shifts
+        '''
+        parts = pool.map(lambda start: self.shifted(start, shifts).sum(axis=0), self.batches())
+        return sum(parts, np.zeros(self.ffts.shape[1:], dtype='c8'))
+
+    def align(self, stack):
+        '''
+        (rows, cols) pixel shifts that align each frame of the stack to the
+        sum of the others, centered on their mean
+        '''
+        envelope = weights(tuple(stack.shape[-2:]), self.apix, self.bfactor, self.lines)
+        radius = int(np.ceil(self.max_shift / self.apix))
+        with ThreadPoolExecutor(self.threads) as pool:
+            self.transform(stack, pool)
+            shifts = np.zeros((len(self.ffts), 2), dtype='f4')
+            for iteration in range(self.iterations):
+                total = self.total(shifts, pool)
+
+                def measure(start):
+                    shifted = self.shifted(start, shifts)
+                    product = (total - shifted) * np.conj(shifted) * envelope
+                    return peaks(fft.irfftn(product, axes=(-2, -1), size=self.shape[1], threads=1), radius)
+
+                updates = np.concatenate(list(pool.map(measure, self.batches())))
+                shifts += updates
+                shifts -= shifts.mean(axis=0)
+                if np.max(np.abs(updates)) * self.apix < self.threshold:
+                    break
+        self.shifts = shifts
+        return shifts
+
+    def sum(self):
+        '''
+        the aligned sum of the frames
+        '''
+        with ThreadPoolExecutor(self.threads) as pool:
+            total = self.total(self.shifts, pool)
+        return fft.irfftn(total, size=self.shape[1])
+
+    def frames(self):
+        '''
+        iterates over the aligned frames `batch` at a time
+        '''
+        with ThreadPoolExecutor(self.threads) as pool:
+            inverse = lambda start: fft.irfftn(self.shifted(start, self.shifts), axes=(-2, -1),
+                                               size=self.shape[1], threads=1)
+            for frames in pool.map(inverse, self.batches()):
+                yield frames
+
+
+def write_shifts(path, shifts, apix, source=None):
+    '''
+    writes shifts in the unblur text format, a line of X then a line of Y
+    shifts in angstroms
+    '''
+    shifts = np.asarray(shifts) * apix
+    with open(path, 'w') as dst:
+        if source is not None:
+            dst.write('# Shifts for input stack : %s\n' % source)
+        dst.write('# Shifts below are given in Angstroms\n')
+        dst.write('# X shifts, then Y shifts\n')
+        for values in (shifts[:, 1], shifts[:, 0]):
+            dst.write(' '.join('%.6f' % value for value in values) + '\n')
+    return path
+
+
+def read_shifts(path, apix):
+    '''
+    reads an unblur format shifts file as (rows, cols) pixel shifts
+    '''
+    coords = []
+    with open(path) as src:
+        for line in src:
+            try:
+                coords += [list(map(float, line.split()))]
+            except ValueError:
+                pass
+    coords = [values for values in coords if values]
+    return np.stack([coords[1], coords[0]], axis=1).astype('f4') / apix
+
+
+def align(src, apix, sum_path=None, shifts_path=None, frames_path=None, threads=None, **kwargs):
+    '''
+    aligns the frames of an MRC stack, writing the aligned sum, the shifts
+    and the aligned frames to whichever paths are given.  returns the shifts
+    '''
+    mrc = FORMATS['mrc']
+    aligner = Aligner(apix, threads=threads, **kwargs)
+    shifts = aligner.align(mrc.MrcStack(src, mode='r'))
+    if shifts_path is not None:
+        write_shifts(shifts_path, shifts, apix, src)
+    if sum_path is not None:
+        mrc.save(aligner.sum(), sum_path)
+    if frames_path is not None:
+        with mrc.MrcWriter(frames_path, dtype='f4', threads=threads) as dst:
+            for frames in aligner.frames():
+                dst.write(frames)
+    return shifts
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+
+import sys
+import json
+import timeit
+import subprocess
+
+# seconds a fresh interpreter may take to import imaging
+IMPORT_BUDGET = 0.5
+
+# modules that must only be loaded when a submodule needing them is used
+HEAVY = ['pyfftw', 'cv2', 'scipy', 'numba']
+
+
+def report(name, seconds, count):
+    print('%-32s %12.3f us/call' % (name, seconds / count * 1e6))
+
+
+def formats(count=100000):
+    '''
+    per-call cost of looking up a format plugin against a plain dictionary
+    '''
+    from imaging.formats import FORMATS, format_of
+    FORMATS['mrc']
+    table = {'mrc': FORMATS['mrc']}
+    report('dict lookup', timeit.timeit(lambda: table['mrc'], number=count), count)
+    report('FORMATS[ext]', timeit.timeit(lambda: FORMATS['mrc'], number=count), count)
+    report('ext in FORMATS', timeit.timeit(lambda: 'mrc' in FORMATS, number=count), count)
+    report('FORMATS[format_of(path)]', timeit.timeit(lambda: FORMATS[format_of('a/b.mrc')], number=count), count)
+
+
+def imports(budget=IMPORT_BUDGET, repeat=5):
+    '''
+    time to import imaging in a fresh interpreter, best of `repeat`.  fails
+    when that is over `budget` seconds or when a heavy backend gets loaded
+    '''
+    code = ('import sys, time, json; start = time.perf_counter(); import imaging; '
+            'print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))')
+    best, loaded = None, []
+    for _ in range(repeat):
+        seconds, modules = json.loads(subprocess.check_output([sys.executable, '-c', code]))
+        best = seconds if best is None else min(best, seconds)
+        loaded = [name for name in HEAVY if name in modules]
+    report('import imaging', best, 1)
+    if loaded:
+        print('import imaging loaded %s' % ', '.join(loaded))
+    if best > budget:
+        print('import imaging took %.3f s, over the %.3f s budget' % (best, budget))
+    return best <= budget and not loaded
+
+
+def percentiles(size=4096, repeat=3):
+    '''
+    the 1% tail means used by filters.norm on a size x size image, from a
+    full sort against the partition, histogram and subsample methods
+    '''
+    import numpy as np
+    from imaging import filters
+    image = np.random.default_rng(0).normal(size=(size, size)).astype('f4')
+    count = int(0.01 * image.size)
+    bands = [(0, count), (image.size - count, image.size)]
+
+    def by_sort():
+        values = np.sort(image, axis=None)
+        return [(np.mean(values[start:stop]), np.std(values[start:stop])) for start, stop in bands]
+
+    exact = by_sort()
+    methods = [('sort', by_sort)] + [
+        (method, lambda method=method: filters.band_stats(image, bands, method))
+        for method in ('exact', 'histogram', 'subsample')]
+    for name, func in methods:
+        seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+        error = max(abs(float(got[0]) - float(want[0])) for got, want in zip(func(), exact))
+        report('%s (error %.2e)' % (name, error), seconds, 1)
+
+
+def ffts(size=2048, repeat=3):
+    '''
+    forward and inverse real transform of a size x size image on each
+    available fft backend, the fastest is the one picked when none is set
+    '''
+    from imaging import fft
+    times = fft.backends.measure((size, size), repeat)
+    for name in sorted(times):
+        report('%s (%d threads)' % (name, fft.THREADS), times[name][0], 1)
+
+
+BENCHMARKS = {
+    'ffts': ffts,
+    'formats': formats,
+    'imports': imports,
+    'percentiles': percentiles,
+}
+
+
+if __name__ == '__main__':
+    failed = []
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('%s:' % name)
+        if BENCHMARKS[name]() is False:
+            failed += [name]
+    sys.exit(1 if failed else 0)
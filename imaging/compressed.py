@@ -0,0 +1,228 @@
+from __future__ import absolute_import
+
+import os
+import bz2
+import gzip
+import mmap
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import pyfs
+
+EXTENSIONS = ["bz2", "gz", "zst"]
+
+CHUNK = 1 << 22
+
+ZSTD_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE = 0x184D2A50
+
+
+def is_compressed(path):
+    return pyfs.gext(path, last=True) in EXTENSIONS
+
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('reading .zst files requires the zstandard module')
+    return zstandard
+
+
+def stream(path):
+    '''
+    opens a compressed file as a file-like object of its decompressed bytes
+    '''
+    ext = pyfs.gext(path, last=True)
+    if ext == 'bz2':
+        return bz2.open(path, 'rb')
+    elif ext == 'gz':
+        return gzip.open(path, 'rb')
+    elif ext == 'zst':
+        return zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    raise ValueError('file {file!s} is not compressed'.format(file=path))
+
+
+def zstd_frames(data):
+    '''
+    finds the boundaries of the frames in a zstd file along with the
+    decompressed size stored in each frame header, or None when it is absent
+    '''
+    frames = []
+    pos = 0
+    while pos < len(data):
+        magic, = struct.unpack_from('<I', data, pos)
+        if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE:
+            size, = struct.unpack_from('<I', data, pos + 4)
+            pos += 8 + size
+            continue
+        if magic != ZSTD_MAGIC:
+            raise ValueError('bad zstd frame at byte %d' % pos)
+        start = pos
+        descriptor = data[pos + 4]
+        fcs_flag = descriptor >> 6
+        single_segment = (descriptor >> 5) & 1
+        checksum = (descriptor >> 2) & 1
+        pos += 5 + (0 if single_segment else 1) + [0, 1, 2, 4][descriptor & 3]
+        fcs_size = [single_segment, 2, 4, 8][fcs_flag]
+        content = None
+        if fcs_size:
+            content = int.from_bytes(data[pos:pos + fcs_size], 'little')
+            if fcs_size == 2:
+                content += 256
+        pos += fcs_size
+        last = False
+        while not last:
+            block = int.from_bytes(data[pos:pos + 3], 'little')
+            last = bool(block & 1)
+            size = 1 if (block >> 1) & 3 == 1 else block >> 3
+            pos += 3 + size
+        pos += 4 * checksum
+        frames += [(start, pos, content)]
+    return frames
+
+
+def ordered(pool, func, items, window):
+    '''
+    maps over items on a pool keeping at most `window` results in flight
+    '''
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def chunks(path, size=CHUNK, threads=None):
+    '''
+    yields the decompressed bytes of a file in order.  zstd files written
+    as many independent frames (as `zstd -T` does) are decoded in parallel
+    '''
+    if pyfs.gext(path, last=True) == 'zst':
+        with open(path, 'rb') as src:
+            data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            frames = zstd_frames(data)
+            if len(frames) > 1 and all(content is not None for _, _, content in frames):
+                threads = threads or os.cpu_count()
+
+                def decode(frame):
+                    start, stop, content = frame
+                    return zstandard().ZstdDecompressor().decompress(data[start:stop], max_output_size=content)
+
+                with ThreadPoolExecutor(threads) as pool:
+                    for chunk in ordered(pool, decode, frames, 2 * threads):
+                        yield chunk
+                return
+        finally:
+            data.close()
+    with stream(path) as src:
+        while True:
+            chunk = src.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def head(path, count):
+    '''
+    decompresses only the first `count` bytes of a file
+    '''
+    data = b''
+    source = chunks(path)
+    try:
+        for chunk in source:
+            data += chunk
+            if len(data) >= count:
+                break
+    finally:
+        source.close()
+    return data[:count]
+
+
+class Inflater(object):
+
+    '''
+    decompresses a file into an in-memory buffer on a background thread.
+    the buffer is filled in order and the thread stays at most `readahead`
+    bytes ahead of what has been asked for, so pulling the first frames of
+    a movie never decompresses the rest of it
+    '''
+
+    def __init__(self, path, skip, buffer, readahead=CHUNK, threads=None):
+        self.path = path
+        self.skip = skip
+        self.data = buffer.reshape(-1).view('u1')
+        self.readahead = readahead
+        self.threads = threads
+        self.filled = 0
+        self.wanted = 0
+        self.error = None
+        self.done = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            skip = self.skip
+            for chunk in chunks(self.path, threads=self.threads):
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                chunk = np.frombuffer(chunk, dtype='u1')[skip:]
+                skip = 0
+                with self.cond:
+                    while self.filled >= self.wanted + self.readahead and not self.closed:
+                        self.cond.wait()
+                if self.closed:
+                    break
+                count = min(len(chunk), len(self.data) - self.filled)
+                self.data[self.filled:self.filled + count] = chunk[:count]
+                with self.cond:
+                    self.filled += count
+                    self.cond.notify_all()
+                if self.filled == len(self.data):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def request(self, count):
+        '''
+        lets the thread decompress up to `count` bytes without waiting for them
+        '''
+        with self.cond:
+            self.wanted = max(self.wanted, count)
+            self.cond.notify_all()
+        return self
+
+    def fill(self, count):
+        '''
+        blocks until at least `count` bytes of the buffer are filled
+        '''
+        self.request(count)
+        with self.cond:
+            while self.filled < count and not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        if self.filled < count:
+            raise ValueError('compressed file {file!s} ended early'.format(file=self.path))
+        return self
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
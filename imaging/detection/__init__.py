@@ -1,5 +1,25 @@
 from __future__ import absolute_import
 
-from .dog import dog
-from .mesa import mesa
-from .keypoints import scale, save, draw, load, window
\ No newline at end of file
+import importlib
+
+from imaging import submodule
+
+# functions re-exported from the submodules that define them
+EXPORTS = {
+    'dog': 'dog',
+    'mesa': 'mesa',
+    'match': 'matching',
+    'scale': 'keypoints',
+    'save': 'keypoints',
+    'draw': 'keypoints',
+    'load': 'keypoints',
+    'window': 'keypoints',
+}
+
+
+def __getattr__(name):
+    if name in EXPORTS:
+        value = getattr(importlib.import_module(__name__ + '.' + EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+    return submodule(__name__, name)
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as nd
+
+from imaging import fft
+from imaging.align import parabola
+
+
+def window_sums(image, shape):
+    '''
+    sums of the image and of its square over every `shape` window lying
+    inside it, from summed-area tables
+    '''
+    rows, cols = shape
+    sums = []
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype='f8')
+    for data in (image, np.square(image)):
+        np.cumsum(data, axis=0, dtype='f8', out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        window = table[rows:, cols:] - table[:-rows, cols:]
+        window -= table[rows:, :-cols]
+        window += table[:-rows, :-cols]
+        sums += [window]
+    return sums
+
+
+def top_peaks(scores, count, distance, threshold):
+    '''
+    (rows, cols, score) of the `count` best local maxima of a score map at
+    least `distance` pixels apart, refined by a parabola along each axis
+    '''
+    size = 2 * int(distance) + 1
+    maxima = (scores == nd.maximum_filter(scores, size=size, mode='nearest')) & (scores > threshold)
+    rows, cols = np.nonzero(maxima)
+    values = scores[rows, cols]
+    if len(values) > count:
+        best = np.argpartition(values, -count)[-count:]
+        rows, cols, values = rows[best], cols[best], values[best]
+    order = np.argsort(values)[::-1]
+    rows, cols, values = rows[order], cols[order], values[order]
+    height, width = scores.shape
+    inner_rows, inner_cols = np.clip(rows, 1, height - 2), np.clip(cols, 1, width - 2)
+    drows = np.where(inner_rows == rows, parabola(scores[inner_rows - 1, cols], scores[inner_rows, cols],
+                                                  scores[inner_rows + 1, cols]), 0.0)
+    dcols = np.where(inner_cols == cols, parabola(scores[rows, inner_cols - 1], scores[rows, inner_cols],
+                                                  scores[rows, inner_cols + 1]), 0.0)
+    return np.stack([rows + drows, cols + dcols, values], axis=1)
+
+
+class Matcher(object):
+
+    '''
+    normalized cross correlation of micrographs of one shape against a set
+    of templates of one shape.  the templates are made zero mean and unit
+    norm, padded to a fast transform size and transformed once.  every
+    micrograph is then transformed once, multiplied by the template
+    transforms `batch` templates at a time across a thread pool, and the
+    correlations are divided by the local standard deviation of the
+    micrograph under the template, found from summed-area tables.  scores
+    are only kept where the template lies inside the micrograph
+    '''
+
+    def __init__(self, templates, shape, batch=4, threads=None):
+        templates = np.asarray(templates, dtype='f8')
+        if templates.ndim == 2:
+            templates = templates[np.newaxis]
+        self.count, self.size = len(templates), templates.shape[1:]
+        self.shape = tuple(shape)
+        self.padded = (fft.fast_size(self.shape[0]), fft.fast_size(self.shape[1]))
+        self.batch = batch
+        self.threads = threads or fft.THREADS
+        templates = templates - templates.mean(axis=(1, 2), keepdims=True)
+        norms = np.sqrt(np.sum(np.square(templates), axis=(1, 2), keepdims=True))
+        templates = templates / np.where(norms > 0, norms, 1.0)
+        padded = np.zeros((self.count,) + self.padded, dtype='f4')
+        padded[:, :self.size[0], :self.size[1]] = templates
+        self.references = np.conj(fft.rfftn(padded, axes=(-2, -1), threads=self.threads)).astype('c8')
+
+    def deviations(self, image):
+        '''
+        square root of the summed squared deviation from the mean under the
+        template at every position, zero where the image is flat
+        '''
+        sums, variance = window_sums(image, self.size)
+        sums *= sums
+        sums /= float(self.size[0] * self.size[1])
+        variance -= sums
+        np.clip(variance, 0.0, None, out=variance)
+        return np.sqrt(variance, dtype='f4')
+
+    def scores(self, image):
+        '''
+        iterates over the normalized cross correlation maps of the image with
+        each template, indexed by the top left corner of the template
+        '''
+        image = np.asarray(image, dtype='f4')
+        if image.shape != self.shape:
+            raise ValueError('matcher is for %s images, got %s' % (self.shape, image.shape))
+        padded = np.zeros(self.padded, dtype='f4')
+        padded[:self.shape[0], :self.shape[1]] = image
+        image_fft = fft.rfftn(padded, threads=self.threads)
+        deviations = self.deviations(image)
+        flat = deviations <= 1e-6 * max(float(deviations.max()), 1e-30)
+        rows, cols = deviations.shape
+        np.copyto(deviations, 1.0, where=flat)
+
+        def correlate(start):
+            products = image_fft * self.references[start:start + self.batch]
+            maps = fft.irfftn(products, axes=(-2, -1), size=self.padded[1], threads=1)[:, :rows, :cols]
+            maps = maps / deviations
+            maps[:, flat] = 0.0
+            return maps
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            for maps in pool.map(correlate, range(0, self.count, self.batch)):
+                for scores in maps:
+                    yield scores
+
+    def match(self, image, count=10, distance=None, threshold=0.0):
+        '''
+        the `count` best (row, col, score) matches of each template in the
+        image, at least `distance` pixels apart, half the template size by
+        default.  positions are of the template center, to subpixel precision
+        '''
+        distance = distance or max(1, min(self.size) // 2)
+        center = np.array([self.size[0] // 2, self.size[1] // 2, 0.0])
+        return [top_peaks(scores, count, distance, threshold) + center for scores in self.scores(image)]
+
+    def stream(self, images, **kwargs):
+        '''
+        matches a sequence of images, such as micrographs loaded one by one
+        '''
+        for image in images:
+            yield self.match(image, **kwargs)
+
+
+def match(image, templates, count=10, distance=None, threshold=0.0, threads=None):
+    '''
+    the `count` best matches of each template in one image, see Matcher
+    '''
+    matcher = Matcher(templates, np.shape(image), threads=threads)
+    return matcher.match(image, count, distance, threshold)
@@ -1,97 +1,657 @@
 from __future__ import absolute_import
 
+import os
+import re
 import pyfs
-import weakref
+import time
+import pickle
+import socket
+import platform
+import atexit
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pyfftw
 
 import imaging.filters as filters
 
+# transform backend ('numpy', 'scipy' or 'fftw'), when unset the fastest
+# available one is measured the first time a transform is run
+BACKEND = os.environ.get('IMAGING_FFT_BACKEND')
+
+# threads used by each transform, shared by every backend that can use them
+THREADS = int(os.environ.get('IMAGING_FFT_THREADS', 0)) or os.cpu_count() or 1
+
+# bytes the tiles of a tiled convolution may use across all threads
+TILE_BUDGET = 256 << 20
+
+
+def fftw():
+    try:
+        import pyfftw
+    except ImportError:
+        raise ImportError('the fftw backend requires the pyfftw module')
+    return pyfftw
+
 
 class wisdom(object):
 
-    paths = [
-        'pyfftw.wisdom'
-    ]
+    '''
+    fftw wisdom kept per machine in `directory`, one file per cpu model, or
+    per hostname when `by` is 'host', as plans measured on one kind of node
+    are not the fastest on another.  wisdom is loaded before the first plan
+    is made and merged back into the file at exit when new plans were made
+    '''
+
+    directory = os.environ.get('IMAGING_FFT_WISDOM',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'imaging', 'wisdom'))
+    by = os.environ.get('IMAGING_FFT_WISDOM_BY', 'cpu')
+
+    loaded = False
+    dirty = False
 
     @classmethod
-    def load(cls):
+    def key(cls):
+        name = None
+        if cls.by == 'cpu':
+            try:
+                with open('/proc/cpuinfo') as src:
+                    for line in src:
+                        if line.startswith('model name'):
+                            name = line.split(':', 1)[1]
+                            break
+            except IOError:
+                pass
+            name = name or platform.processor()
+        name = name or socket.gethostname()
+        return re.sub(r'[^A-Za-z0-9.]+', '-', name.strip()).strip('-')
+
+    @classmethod
+    def path(cls):
+        return os.path.join(cls.directory, cls.key() + '.wisdom')
+
+    @classmethod
+    def once(cls):
+        '''
+        loads the saved wisdom before the first plan is made rather than
+        when the module is imported, and saves it once at exit
+        '''
+        if not cls.loaded:
+            cls.load()
+            atexit.register(cls.flush)
+
+    @classmethod
+    def flush(cls):
+        if cls.dirty:
+            cls.save()
+
+    @classmethod
+    def read(cls, path):
         try:
-            import pickle
-            with pyfs.aopen(cls.paths[0], 'rb') as src:
-                wisdom = pickle.load(src)
-            print(wisdom)
-            pyfftw.import_wisdom(wisdom)
-        except pyfs.errors.FileNotFoundError:
-            pass
+            with open(path, 'rb') as src:
+                return pickle.load(src)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
 
     @classmethod
-    def save(cls):
+    def write(cls, path, wisdom):
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
         try:
-            import pickle
-            wisdom = pyfftw.export_wisdom()
-            with pyfs.aopen(cls.paths[0], 'wb') as dst:
+            with open(tmppath, 'wb') as dst:
                 pickle.dump(wisdom, dst)
-        except IOError:
-            pass
+            os.replace(tmppath, path)
+        except (IOError, OSError):
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    @classmethod
+    def load(cls):
+        cls.loaded = True
+        wisdom = cls.read(cls.path())
+        if wisdom is not None:
+            fftw().import_wisdom(wisdom)
+
+    @classmethod
+    def save(cls):
+        '''
+        merges the wisdom of this process into the saved wisdom.  the merge
+        holds a lock on the file, and the merged wisdom replaces it with a
+        rename, so concurrent workers neither lose each other's plans nor
+        ever read a partly written file
+        '''
+        path = cls.path()
+        try:
+            os.makedirs(cls.directory, exist_ok=True)
+        except OSError:
+            return
+        with pyfs.lock(path):
+            wisdom = cls.read(path)
+            if wisdom is not None:
+                fftw().import_wisdom(wisdom)
+            cls.write(path, fftw().export_wisdom())
+        cls.dirty = False
 
     @classmethod
     def reset(cls):
-        pyfftw.forget_wisdom()
-        cls.save()
+        fftw().forget_wisdom()
+        path = cls.path()
+        with pyfs.lock(path):
+            cls.write(path, fftw().export_wisdom())
+        cls.dirty = False
+
+    @classmethod
+    def train(cls, shape, dtype='f4', axes=(-2, -1), threads=None, effort='FFTW_MEASURE'):
+        '''
+        plans the forward and inverse real transforms of `shape` data over
+        `axes` with the given planner effort, so later plans of the shape
+        come straight from wisdom.  the wisdom is not saved until flushed
+        '''
+        cls.once()
+        shape = tuple(shape)
+        axes = tuple(axis % len(shape) for axis in axes)
+        half = shape[:axes[-1]] + (shape[axes[-1]] // 2 + 1,) + shape[axes[-1]+1:]
+        Plan(False, shape, real_dtype(dtype), axes, threads or THREADS, effort=effort)
+        Plan(True, half, complex_dtype(dtype), axes, threads or THREADS, shape[axes[-1]], effort=effort)
+        cls.dirty = True
 
     @classmethod
     def measure(cls, a):
-        b = pyfftw.builders.rfftn(a, planner_effort='FFTW_MEASURE')()
-        c = pyfftw.builders.irfftn(b, planner_effort='FFTW_MEASURE')()
+        cls.train(a.shape, a.dtype, axes=range(a.ndim))
         cls.save()
-        return c
 
-wisdom.load()
 
+class Cache(object):
+
+    '''
+    least recently used cache of transform results held to a budget of
+    bytes.  results are keyed by the function and a fingerprint of the
+    argument: its shape, dtype and a digest of all of its values, so an
+    array modified in place or a buffer reused for the next frame misses,
+    and equal arrays hit wherever their data is.  the default budget holds
+    the transform of a full 8k x 8k frame.  cached results are read-only
+    since they are shared between callers
+    '''
+
+    def __init__(self, budget=512 << 20):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(data):
+        '''
+        key for an array from a SHA-1 of every value, read in place when the
+        array is contiguous.  hashing runs at over a gigabyte a second, well
+        below the cost of the transforms being cached
+        '''
+        values = np.ascontiguousarray(data)
+        digest = hashlib.sha1(memoryview(values).cast('B')).hexdigest()
+        return (data.shape, data.dtype.str, digest)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if value.nbytes > self.budget:
+            return value
+        value.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.bytes += value.nbytes
+            while self.bytes > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes, 'budget': self.budget}
+
+
+# transforms cached by `cached`, set cache.budget to change its size
+cache = Cache()
+
+
+def cached(nbytes):
+    '''
+    caches the results of a transform of one array in the shared cache,
+    `nbytes` gives the size of the result so ones that could never fit in
+    the cache are not fingerprinted
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(data):
+            data = np.asarray(data)
+            if nbytes(data) > cache.budget:
+                return func(data)
+            key = (func.__name__,) + Cache.fingerprint(data)
+            result = cache.get(key)
+            if result is None:
+                result = cache.put(key, func(data))
+            return result
+        return wrapper
+    return decorator
+
+
+class Plan(object):
+
+    '''
+    a pyfftw real transform planned once on SIMD aligned buffers of its
+    shape.  forward plans preserve their input, so they run straight from
+    the caller's array when it is contiguous and aligned, and inverse
+    plans copy the input in first as fftw overwrites it.  every call
+    writes into a new aligned output array.  plans are made from saved
+    wisdom when there is some for the shape and estimated otherwise, or
+    planned with the given planner `effort`.  a plan runs one transform at
+    a time, see `plans`
+    '''
+
+    def __init__(self, inverse, shape, dtype, axes, threads, size=None, effort=None):
+        wisdom.once()
+        shape, last = tuple(shape), axes[-1]
+        dtype = np.dtype(dtype)
+        if inverse:
+            size = size or 2 * (shape[last] - 1)
+            out_shape = shape[:last] + (size,) + shape[last+1:]
+            out_dtype = np.dtype('f4') if dtype == np.dtype('c8') else np.dtype('f8')
+        else:
+            out_shape = shape[:last] + (shape[last] // 2 + 1,) + shape[last+1:]
+            out_dtype = np.dtype('c8') if dtype == np.dtype('f4') else np.dtype('c16')
+        pyfftw = fftw()
+        self.inverse = inverse
+        self.input = pyfftw.empty_aligned(shape, dtype)
+        self.output = pyfftw.empty_aligned(out_shape, out_dtype)
+        self.nbytes = self.input.nbytes + self.output.nbytes
+        direction = 'FFTW_BACKWARD' if inverse else 'FFTW_FORWARD'
+        keep = ('FFTW_DESTROY_INPUT',) if inverse else ()
+        try:
+            flags = ((effort,) if effort else ('FFTW_MEASURE', 'FFTW_WISDOM_ONLY')) + keep
+            self.fftw = pyfftw.FFTW(self.input, self.output, axes, direction, flags, threads)
+        except RuntimeError:
+            self.fftw = pyfftw.FFTW(self.input, self.output, axes, direction, ('FFTW_ESTIMATE',) + keep, threads)
+            wisdom.dirty = True
+
+    def runs_in_place(self, data):
+        return not self.inverse and data.dtype == self.input.dtype and data.flags.c_contiguous and \
+            data.ctypes.data % self.fftw.input_alignment == 0
+
+    def __call__(self, data):
+        if self.runs_in_place(data):
+            source = data
+        else:
+            self.input[...] = data
+            source = self.input
+        output = fftw().empty_aligned(self.output.shape, self.output.dtype)
+        self.fftw(source, output)
+        # the plan goes back to its own buffers so it does not keep the
+        # caller's arrays alive while idle
+        self.fftw.update_arrays(self.input, self.output)
+        return output
+
+
+class plans(object):
+
+    '''
+    idle plans kept by direction, shape, dtype, axes, thread count and
+    output size, so repeated transforms of the same shape only run the
+    transform.  each transform checks out a plan of its own, so transforms
+    of one shape on a thread pool run side by side on as many plans as
+    there are concurrent callers.  idle plans are held to a budget of bytes
+    of buffers, the least recently used are dropped first
+    '''
+
+    budget = 1 << 30
+    idle = OrderedDict()
+    bytes = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def run(cls, inverse, data, dtype, axes, threads=None, size=None):
+        threads = threads or THREADS
+        key = (inverse, data.shape, np.dtype(dtype).str, tuple(axes), threads, size)
+        plan = cls.checkout(key)
+        if plan is None:
+            plan = Plan(inverse, data.shape, dtype, axes, threads, size)
+        try:
+            return plan(data)
+        finally:
+            cls.checkin(key, plan)
+
+    @classmethod
+    def checkout(cls, key):
+        with cls.lock:
+            idle = cls.idle.get(key)
+            if not idle:
+                return None
+            plan = idle.pop()
+            if not idle:
+                del cls.idle[key]
+            cls.bytes -= plan.nbytes
+            return plan
+
+    @classmethod
+    def checkin(cls, key, plan):
+        if plan.nbytes > cls.budget:
+            return
+        with cls.lock:
+            cls.idle.setdefault(key, []).append(plan)
+            cls.idle.move_to_end(key)
+            cls.bytes += plan.nbytes
+            while cls.bytes > cls.budget:
+                oldest = next(iter(cls.idle))
+                cls.bytes -= cls.idle[oldest].pop(0).nbytes
+                if not cls.idle[oldest]:
+                    del cls.idle[oldest]
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.idle.clear()
+            cls.bytes = 0
+
+
+def real_dtype(dtype):
+    return np.dtype('f4') if np.dtype(dtype) == np.dtype('f4') else np.dtype('f8')
+
+
+def complex_dtype(dtype):
+    return np.dtype('c8') if np.dtype(dtype) in (np.dtype('c8'), np.dtype('f4')) else np.dtype('c16')
+
+
+def output_shape(data, axes, size):
+    return [data.shape[axis] for axis in axes[:-1]] + [size or 2 * (data.shape[axes[-1]] - 1)]
+
+
+class NumpyBackend(object):
+
+    name = 'numpy'
+
+    def rfftn(self, data, axes, threads):
+        return np.fft.rfftn(data, axes=axes)
+
+    def irfftn(self, data, axes, size, threads):
+        return np.fft.irfftn(data, s=output_shape(data, axes, size), axes=axes)
+
+
+class ScipyBackend(object):
+
+    name = 'scipy'
+
+    def __init__(self):
+        import scipy.fft
+        self.fft = scipy.fft
+
+    def rfftn(self, data, axes, threads):
+        return self.fft.rfftn(data, axes=axes, workers=threads)
+
+    def irfftn(self, data, axes, size, threads):
+        return self.fft.irfftn(data, s=output_shape(data, axes, size), axes=axes, workers=threads)
+
+
+class FftwBackend(object):
+
+    name = 'fftw'
+
+    def __init__(self):
+        fftw()
+
+    def rfftn(self, data, axes, threads):
+        return plans.run(False, data, real_dtype(data.dtype), axes, threads)
+
+    def irfftn(self, data, axes, size, threads):
+        return plans.run(True, data, complex_dtype(data.dtype), axes, threads, size)
+
+
+class backends(object):
+
+    '''
+    the transform backend every function here runs on, set by BACKEND or
+    picked once by timing the available ones on a test image
+    '''
+
+    kinds = {
+        'numpy': NumpyBackend,
+        'scipy': ScipyBackend,
+        'fftw': FftwBackend,
+    }
+
+    current = None
+    lock = threading.Lock()
 
-def wcache(func):
+    @classmethod
+    def get(cls):
+        if cls.current is None:
+            with cls.lock:
+                if cls.current is None:
+                    cls.current = cls.kinds[BACKEND]() if BACKEND else cls.fastest()
+        return cls.current
+
+    @classmethod
+    def use(cls, name):
+        cls.current = cls.kinds[name]()
+        return cls.current
+
+    @classmethod
+    def available(cls):
+        found = []
+        for name in sorted(cls.kinds):
+            try:
+                found += [cls.kinds[name]()]
+            except ImportError:
+                pass
+        return found
+
+    @classmethod
+    def measure(cls, shape=(512, 512), repeat=3, threads=None):
+        '''
+        best time of a forward and inverse transform of a test image on each
+        available backend, after a first run that makes any plans
+        '''
+        threads = threads or THREADS
+        data = np.random.default_rng(0).random(shape, dtype='f4')
+        axes = tuple(range(data.ndim))
+        times = {}
+        for backend in cls.available():
+            backend.irfftn(backend.rfftn(data, axes, threads), axes, shape[-1], threads)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                backend.irfftn(backend.rfftn(data, axes, threads), axes, shape[-1], threads)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            times[backend.name] = (best, backend)
+        return times
+
+    @classmethod
+    def fastest(cls):
+        times = cls.measure()
+        return min(times.values(), key=lambda entry: entry[0])[1]
+
+
+def axes_of(data, axes):
+    axes = tuple(range(data.ndim)) if axes is None else tuple(axes)
+    return tuple(axis % data.ndim for axis in axes)
+
+
+def rfftn(data, axes=None, threads=None):
+    '''
+    real forward transform over `axes`, all of them by default
+    '''
+    data = np.asarray(data)
+    return backends.get().rfftn(data, axes_of(data, axes), threads or THREADS)
+
+
+def irfftn(data, axes=None, size=None, threads=None):
     '''
-    this decorator is specifically to cache FFTs of images as long
-    as the image still exists.  It uses reakrefs to the source images
-    to store the I/FFTs.
+    real inverse transform over `axes`, the last of which is `size` long in
+    the output, by default the even length matching the input
     '''
-    kcache = {}
+    data = np.asarray(data)
+    return backends.get().irfftn(data, axes_of(data, axes), size, threads or THREADS)
 
-    def wcached(arg):
-        oid = id(arg)
-        if oid not in kcache:
-            def remove(r):
-                del kcache[oid]
-            ref = weakref.ref(arg, remove)
-            kcache[oid] = (ref, func(arg))
-        return kcache[oid][1]
 
-    return wcached
+def rfft_bytes(data):
+    half = data.shape[:-1] + (data.shape[-1] // 2 + 1,)
+    return int(np.prod(half)) * complex_dtype(data.dtype).itemsize
 
 
-@wcache
+def irfft_bytes(data):
+    full = data.shape[:-1] + (2 * (data.shape[-1] - 1),)
+    return int(np.prod(full)) * complex_dtype(data.dtype).itemsize // 2
+
+
+@cached(rfft_bytes)
 def rfft(data):
-    datafft = pyfftw.builders.rfftn(data)()
-    wisdom.save()
-    return datafft
+    return rfftn(data)
 
 
-@wcache
+@cached(irfft_bytes)
 def irfft(data):
-    return pyfftw.builders.irfftn(data)()
+    return irfftn(data)
 
 
 def convolve(src, dst):
-    src_fft = np.fft.rfftn(src)
-    dst_fft = np.fft.rfftn(dst)
-    return np.fft.fftshift(np.fft.irfftn(src_fft * dst_fft))
+    src_fft = rfft(src)
+    dst_fft = rfft(dst)
+    return np.fft.fftshift(irfftn(src_fft * dst_fft, size=src.shape[-1]))
 
 
 def correlate(src, dst):
-    src_fft = np.fft.rfftn(padto(src, maxdims(src, dst)))
-    dst_fft = np.fft.rfftn(padto(ndflip(dst), maxdims(src, dst)))
-    return np.fft.fftshift(np.fft.irfftn(src_fft * np.conj(dst_fft)))
+    # the padded copies are new arrays every call, caching them is no use
+    src_fft = rfftn(padto(src, maxdims(src, dst)))
+    dst_fft = rfftn(padto(ndflip(dst), maxdims(src, dst)))
+    return np.fft.fftshift(irfftn(src_fft * np.conj(dst_fft)))
+
+
+def fast_size(size):
+    '''
+    smallest even size of at least `size` with no prime factors but 2, 3
+    and 5, which every backend transforms quickly
+    '''
+    best = 2
+    while best < size:
+        best *= 2
+    five = 1
+    while five < best:
+        three = five
+        while three < best:
+            even = 2 * three
+            while even < size:
+                even *= 2
+            best = min(best, even)
+            three *= 3
+        five *= 5
+    return best
+
+
+def tile_size(shape, kernel, budget=TILE_BUDGET, threads=None):
+    '''
+    square tile size for an overlap-save convolution of a `shape` image with
+    a `kernel` shape one.  of the fast sizes whose tiles fit the memory
+    budget across `threads` workers, the one with the least transform work
+    per output pixel is picked, or the smallest one if none of them fit
+    '''
+    threads = threads or THREADS
+    overlap = max(kernel) - 1
+    largest = fast_size(max(shape) + overlap)
+    best, least = None, None
+    size = fast_size(overlap + 2)
+    while size <= largest:
+        # a real tile, its transform, the product and the inverse per
+        # worker, and the transform of the kernel shared by all of them
+        if best is not None and (16 * threads + 4) * size * size > budget:
+            break
+        step = size - overlap
+        tiles = -(-shape[0] // step) * -(-shape[1] // step)
+        work = tiles * size * size * np.log2(size)
+        if least is None or work < least:
+            best, least = size, work
+        size = fast_size(size + 1)
+    return best
+
+
+def overlap_save(image, kernel, budget=TILE_BUDGET, threads=None, center=None):
+    '''
+    linear convolution of an image with a small kernel centered on
+    `center`, kernel.shape // 2 by default, the same size as the image
+    with zeros beyond its edges.  the image is cut into tiles of a fast
+    transform size that overlap by the kernel size, each tile is convolved
+    with the kernel transform made once and the part of it not wrapped
+    around is kept.  tiles write disjoint parts of the output, so they run
+    on a thread pool within the memory budget without accumulating into
+    shared memory
+    '''
+    image = np.asarray(image)
+    kernel = np.asarray(kernel, dtype='f4')
+    threads = threads or THREADS
+    rows, cols = image.shape
+    size = tile_size(image.shape, kernel.shape, budget, threads)
+    step_rows, step_cols = size - kernel.shape[0] + 1, size - kernel.shape[1] + 1
+    center = [dim // 2 for dim in kernel.shape] if center is None else center
+    before_rows = kernel.shape[0] - 1 - center[0]
+    before_cols = kernel.shape[1] - 1 - center[1]
+    padded = np.zeros((size, size), dtype='f4')
+    padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+    kernel_fft = rfftn(padded, threads=threads)
+    out = np.empty(image.shape, dtype='f4')
+
+    def convolve_tile(corner):
+        row, col = corner
+        top, left = row - before_rows, col - before_cols
+        tile = np.zeros((size, size), dtype='f4')
+        src_rows = slice(max(top, 0), min(top + size, rows))
+        src_cols = slice(max(left, 0), min(left + size, cols))
+        tile[src_rows.start - top:src_rows.stop - top, src_cols.start - left:src_cols.stop - left] = \
+            image[src_rows, src_cols]
+        tile_fft = rfftn(tile, threads=1)
+        tile_fft *= kernel_fft
+        convolved = irfftn(tile_fft, size=size, threads=1)
+        stop_row, stop_col = min(row + step_rows, rows), min(col + step_cols, cols)
+        out[row:stop_row, col:stop_col] = convolved[kernel.shape[0] - 1:kernel.shape[0] - 1 + stop_row - row,
+                                                    kernel.shape[1] - 1:kernel.shape[1] - 1 + stop_col - col]
+
+    corners = [(row, col) for row in range(0, rows, step_rows) for col in range(0, cols, step_cols)]
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(convolve_tile, corners))
+    return out
+
+
+def convolve_tiled(image, kernel, budget=TILE_BUDGET, threads=None):
+    '''
+    convolves a large image with a small kernel tile by tile, see overlap_save
+    '''
+    return overlap_save(image, kernel, budget, threads)
+
+
+def correlate_tiled(image, kernel, budget=TILE_BUDGET, threads=None):
+    '''
+    correlates a large image with a small kernel centered on
+    kernel.shape // 2 tile by tile, as the convolution with the flipped kernel
+    '''
+    kernel = np.asarray(kernel)
+    center = [dim - 1 - dim // 2 for dim in kernel.shape]
+    return overlap_save(image, ndflip(kernel), budget, threads, center)
 
 
 def ndflip(data):
@@ -100,7 +660,6 @@ def ndflip(data):
 
 
 def maxdims(src, dst):
-    print(src.shape, dst.shape)
     return tuple(np.max([src.shape, dst.shape], axis=0))
 
 
@@ -108,7 +667,7 @@ def padto(data, dims):
     padding = []
     for dst, src in zip(dims, data.shape):
         left = dst - src
-        half = left / 2
+        half = left // 2
         padding += [(half, left-half)]
     return np.pad(data, tuple(padding), mode="edge")
 
@@ -159,26 +718,282 @@ def inbound(shape, shift):
 
 
 def shift(image, shift):
-
-    imagefft = r_center(rfft(image))
-
-    # generate the fft space coeffs
-    # the equation for the phase shift is e^(-2j*pi*(x*(xshift/xdim)+y*(yshift/ydim)))
-    idxs = rmesh(imagefft.shape)
-    norm = np.array(shift, dtype='float64') / np.array(image.shape)
-    norm = idxs * norm.reshape([2]+[1]*image.ndim)
-    norm = np.sum(norm, axis=0)
-    phases = np.exp(0.0-2j*np.pi*norm)
-
-    # shift the image fft phases then take inverse transform
-    rolled = irfft(r_uncenter(imagefft * phases))
+    '''
+    shifts an image by a subpixel (rows, cols) offset, the parts of the
+    image that have no source after the shift are set to its mean
+    '''
+    image = np.asarray(image)
+    rolled = shift_stack(image[np.newaxis], [shift])[0]
 
     # because of the fft we now have an image that has been rolled
     # so we need to extract the valid image parts on a background
-    shifted = np.zeros(image.shape) + np.mean(image)
-    bounds = inbound(image.shape, np.floor(shift))
+    shifted = np.full(image.shape, np.mean(image), dtype=rolled.dtype)
+    bounds = tuple(inbound(image.shape, np.floor(shift).astype(int)))
     shifted[bounds] = rolled[bounds]
 
     return shifted
 
 
+@functools.lru_cache(maxsize=32)
+def frequencies(shape):
+    '''
+    float32 frequencies, in cycles per pixel, of the rows and of the half
+    width columns of the real transform of a `shape` image
+    '''
+    rows = np.fft.fftfreq(shape[0]).astype('f4')
+    cols = np.fft.rfftfreq(shape[1]).astype('f4')
+    rows.flags.writeable = cols.flags.writeable = False
+    return rows, cols
+
+
+def phase_ramps(shape, shifts):
+    '''
+    the separable phase ramps that shift the real transform of a `shape`
+    image by each (rows, cols) offset in `shifts`, as (N, H, 1) row and
+    (N, 1, W/2+1) column factors in complex64
+    '''
+    rows, cols = frequencies(tuple(shape))
+    shifts = np.asarray(shifts, dtype='f4').reshape(-1, 2)
+    phase = np.float32(-2 * np.pi) * 1j
+    return (np.exp(phase * (shifts[:, :1] * rows))[:, :, np.newaxis],
+            np.exp(phase * (shifts[:, 1:] * cols))[:, np.newaxis, :])
+
+
+def shift_stack(stack, shifts, sum=False, batch=8, out=None, threads=None):
+    '''
+    shifts each frame of an (N, H, W) stack by its subpixel (rows, cols)
+    offset in `shifts`, `batch` frames per real transform.  the phase
+    ramps are separable so each frame is multiplied by a row and a column
+    ramp in place, all in float32 complex.  shifts are circular, anything
+    moved past one edge comes back at the other.  with `sum` the shifted
+    transforms are added up and only that sum is transformed back, giving
+    the (H, W) shifted sum rather than the stack
+    '''
+    count, height, width = len(stack), stack.shape[-2], stack.shape[-1]
+    shifts = np.asarray(shifts, dtype='f4').reshape(count, 2)
+    axes = (-2, -1)
+    if out is None:
+        out = np.empty((height, width) if sum else (count, height, width), dtype='f4')
+    total = np.zeros((height, width // 2 + 1), dtype='c8') if sum else None
+    for start in range(0, count, batch):
+        stop = min(start + batch, count)
+        frames = np.asarray(stack[start:stop], dtype='f4')
+        ffts = np.asarray(rfftn(frames, axes=axes, threads=threads), dtype='c8')
+        row_ramps, col_ramps = phase_ramps((height, width), shifts[start:stop])
+        ffts *= row_ramps
+        ffts *= col_ramps
+        if sum:
+            total += ffts.sum(axis=0)
+        else:
+            out[start:stop] = irfftn(ffts, axes=axes, size=width, threads=threads)
+    if sum:
+        out[...] = irfftn(total, size=width, threads=threads)
+    return out
+
+
+def shape_of(stack):
+    # lazily loaded stacks have a shape, but asking numpy would load them
+    return tuple(stack.shape) if hasattr(stack, 'shape') else np.shape(stack)
+
+
+def fourier_shape(shape, size):
+    '''
+    (rows, cols) an image of `shape` is resized to by `size`, either a size
+    in pixels, the same for both axes or a (rows, cols) pair, or a float
+    factor the shape is scaled by and rounded to even sizes
+    '''
+    sizes = size if isinstance(size, (tuple, list)) else (size, size)
+    resized = []
+    for dim, size in zip(shape[-2:], sizes):
+        if isinstance(size, (float, np.floating)):
+            size = 2 * int(round(dim * size / 2.0))
+        resized += [int(size)]
+    if min(resized) < 1:
+        raise ValueError('can not resize %s images to %s' % (tuple(shape[-2:]), tuple(resized)))
+    return tuple(resized)
+
+
+def resample(stack, size, batch=8, out=None, threads=None):
+    '''
+    resizes an image or an (N, H, W) stack by keeping only the frequencies
+    that fit the new size, or by surrounding them with zeros when it is
+    larger.  the kept part of each half-plane transform is copied straight
+    into the transform of the new size, and pixel values keep their scale.
+    frames are resampled `batch` at a time across a thread pool, and when
+    there are fewer batches than threads the rest go to each transform
+    '''
+    single = len(shape_of(stack)) == 2
+    if single:
+        stack = np.asarray(stack)[np.newaxis]
+    count, height, width = len(stack), stack.shape[-2], stack.shape[-1]
+    rows, cols = fourier_shape((height, width), size)
+    kept = min(rows, height)
+    low, high, half = (kept + 1) // 2, kept // 2, min(cols, width) // 2 + 1
+    scale = np.float32(float(rows * cols) / (height * width))
+    if out is None:
+        out = np.empty((count, rows, cols), dtype='f4')
+    allocate = np.empty if rows <= height and cols <= width else np.zeros
+    threads = threads or THREADS
+    batches = range(0, count, batch)
+    workers = max(1, min(threads, len(batches)))
+    transform_threads = max(1, threads // workers)
+
+    def resample_batch(start):
+        stop = min(start + batch, count)
+        ffts = rfftn(np.asarray(stack[start:stop], dtype='f4'), axes=(-2, -1), threads=transform_threads)
+        resized = allocate((stop - start, rows, cols // 2 + 1), dtype='c8')
+        resized[:, :low, :half] = ffts[:, :low, :half]
+        if high:
+            resized[:, rows - high:, :half] = ffts[:, height - high:, :half]
+        resized *= scale
+        out[start:stop] = irfftn(resized, axes=(-2, -1), size=cols, threads=transform_threads)
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(resample_batch, batches))
+    return out[0] if single else out
+
+
+def crop(stack, size, **kwargs):
+    '''
+    fourier crops an image or a stack down to `size`, binning without aliasing
+    '''
+    shape = shape_of(stack)[-2:]
+    rows, cols = fourier_shape(shape, size)
+    if rows > shape[0] or cols > shape[1]:
+        raise ValueError('can not crop %s images up to %s' % (tuple(shape), (rows, cols)))
+    return resample(stack, (rows, cols), **kwargs)
+
+
+def pad(stack, size, **kwargs):
+    '''
+    fourier pads an image or a stack up to `size`
+    '''
+    shape = shape_of(stack)[-2:]
+    rows, cols = fourier_shape(shape, size)
+    if rows < shape[0] or cols < shape[1]:
+        raise ValueError('can not pad %s images down to %s' % (tuple(shape), (rows, cols)))
+    return resample(stack, (rows, cols), **kwargs)
+
+
+@functools.lru_cache(maxsize=8)
+def hann(size):
+    '''
+    2D hann window for `size` tiles scaled so its squares sum to the tile
+    size, which keeps windowed power on the scale of unwindowed power
+    '''
+    window = np.outer(np.hanning(size), np.hanning(size)).astype('f4')
+    window *= np.float32(size / np.sqrt(np.sum(np.square(window, dtype='f8'))))
+    window.flags.writeable = False
+    return window
+
+
+@functools.lru_cache(maxsize=8)
+def radii(size):
+    '''
+    integer radius, in frequency samples, of each point of the real
+    transform of a `size` tile
+    '''
+    rows, cols = frequencies((size, size))
+    radius = np.sqrt(rows[:, np.newaxis] ** 2 + cols[np.newaxis, :] ** 2) * size
+    radius = np.rint(radius).astype(np.intp)
+    radius.flags.writeable = False
+    return radius
+
+
+def full_power(half):
+    '''
+    the centered (size, size) power spectrum from the half-plane one of a
+    real transform, mirroring the missing columns
+    '''
+    size = half.shape[0]
+    full = np.empty((size, size), dtype=half.dtype)
+    full[:, :half.shape[1]] = half
+    mirrored = np.arange(half.shape[1], size)
+    full[:, half.shape[1]:] = half[(-np.arange(size)) % size][:, size - mirrored]
+    return np.fft.fftshift(full)
+
+
+def rotational_average(half):
+    '''
+    mean of a half-plane power spectrum over rings one frequency sample
+    wide, out to the nyquist frequency
+    '''
+    size = half.shape[0]
+    radius = radii(size)
+    sums = np.bincount(radius.ravel(), weights=half.ravel(), minlength=size // 2 + 1)
+    counts = np.bincount(radius.ravel(), minlength=size // 2 + 1)
+    return (sums / np.maximum(counts, 1))[:size // 2 + 1].astype('f4')
+
+
+class Periodogram(object):
+
+    '''
+    welch averaged power spectrum of `size` tiles.  images or frame stacks
+    are added one frame at a time, each frame is cut into tiles overlapping
+    by `overlap`, the tiles have their mean removed and are hann windowed,
+    and their power spectra are summed in float32 `batch` tiles at a time
+    across a thread pool.  only the running sum and one batch of tiles per
+    thread are held, so it can run over any number of micrographs
+    '''
+
+    def __init__(self, size=512, overlap=0.5, batch=8, threads=None):
+        self.size = int(size)
+        self.step = max(1, int(round(self.size * (1.0 - overlap))))
+        self.batch = batch
+        self.threads = threads or THREADS
+        self.total = np.zeros((self.size, self.size // 2 + 1), dtype='f4')
+        self.count = 0
+
+    def tiles(self, frame):
+        '''
+        view of the overlapping tiles of a frame, (count, size, size)
+        '''
+        windows = np.lib.stride_tricks.sliding_window_view(frame, (self.size, self.size))
+        windows = windows[::self.step, ::self.step]
+        return windows.reshape((-1, self.size, self.size))
+
+    def power(self, tiles):
+        tiles = np.array(tiles, dtype='f4')
+        tiles -= tiles.mean(axis=(1, 2), keepdims=True)
+        tiles *= hann(self.size)
+        ffts = rfftn(tiles, axes=(-2, -1), threads=1)
+        return np.sum(np.square(ffts.real) + np.square(ffts.imag), axis=0, dtype='f4')
+
+    def add(self, data):
+        '''
+        adds the tiles of an image or of every frame of a stack
+        '''
+        frames = [data] if len(shape_of(data)) == 2 else data
+        with ThreadPoolExecutor(self.threads) as pool:
+            for frame in frames:
+                tiles = self.tiles(np.asarray(frame))
+                batches = [tiles[start:start + self.batch] for start in range(0, len(tiles), self.batch)]
+                for power in pool.map(self.power, batches):
+                    self.total += power
+                self.count += len(tiles)
+        return self
+
+    @property
+    def half(self):
+        return self.total / np.float32(max(self.count, 1) * self.size * self.size)
+
+    def spectrum(self):
+        '''
+        the centered (size, size) average power spectrum
+        '''
+        return full_power(self.half)
+
+    def rotational(self):
+        '''
+        rotational average of the power spectrum out to nyquist
+        '''
+        return rotational_average(self.half)
+
+
+def periodogram(data, size=512, overlap=0.5, threads=None):
+    '''
+    welch averaged power spectrum of an image or a stack, returned as the
+    centered 2D average and its rotational average
+    '''
+    welch = Periodogram(size, overlap, threads=threads).add(data)
+    return welch.spectrum(), welch.rotational()
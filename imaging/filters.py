@@ -50,7 +50,107 @@ def supress(image, threshold=10, neighbors=9):
     return supressed
 
 
-def norm(image, minb=0.01, maxb=0.01, nminv=None, nmaxv=None):
+def sample(image, samples=1 << 18, seed=0):
+    '''
+    a fixed random subsample of the pixels of an image, read in file order
+    '''
+    flat = np.ravel(image)
+    if flat.size <= samples:
+        return flat
+    rng = np.random.default_rng(seed)
+    return flat[np.sort(rng.integers(0, flat.size, samples))]
+
+
+def histogram(image, bins=4096, chunk=1 << 14):
+    '''
+    counts and bin centers over the range of an image.  pixels are scaled
+    to bin numbers and counted with a bincount `chunk` at a time, so the
+    temporaries stay in cache, which is quicker than np.histogram or a
+    sort.  integer images spanning fewer than `bins` values get one bin
+    per value, so their counts are exact
+    '''
+    flat = np.ravel(image)
+    lo, hi = np.min(flat), np.max(flat)
+    exact = flat.dtype.kind in 'ui' and int(hi) - int(lo) < bins
+    if exact:
+        lo, bins = int(lo), int(hi) - int(lo) + 1
+        centers = np.arange(lo, lo + bins, dtype='f8')
+    else:
+        lo, hi = float(lo), float(hi)
+        if not hi > lo:
+            return np.array([flat.size]), np.array([lo])
+        centers = lo + (np.arange(bins) + 0.5) * ((hi - lo) / bins)
+        work = np.result_type(flat.dtype, np.float32)
+        values = np.empty(chunk, dtype=work)
+        lo, scale = work.type(lo), work.type(bins / (hi - lo))
+    numbers = np.empty(chunk, dtype=np.intp)
+    counts = np.zeros(bins, dtype=np.intp)
+    for start in range(0, flat.size, chunk):
+        part = flat[start:start + chunk]
+        index = numbers[:len(part)]
+        if exact:
+            np.subtract(part, lo, out=index, casting='unsafe')
+        else:
+            scaled = values[:len(part)]
+            np.subtract(part, lo, out=scaled)
+            scaled *= scale
+            np.copyto(index, scaled, casting='unsafe')
+            np.minimum(index, bins - 1, out=index)
+        counts += np.bincount(index, minlength=bins)
+    return counts, centers
+
+
+def partition(image, ranks):
+    '''
+    a flat copy of an image with the pixels at the given ranks in sorted
+    position and everything between them in between.  edges are placed one
+    at a time on the shrinking remainder, which is quicker than a single
+    partition with several kth or a full sort
+    '''
+    values = np.array(image).ravel()
+    start = 0
+    for rank in sorted(set(ranks)):
+        values[start:].partition(rank - start)
+        start = rank + 1
+    return values
+
+
+def band_stats(image, bands, method='exact', bins=4096, samples=1 << 18):
+    '''
+    mean and standard deviation of the pixels ranked in each (start, stop)
+    band of an image.  'exact' partitions the pixels around the band edges
+    in linear time instead of sorting them, 'histogram' approximates the
+    bands from a histogram of every pixel, exact for integer images of
+    narrow range, and 'subsample' from an exact partition of a random
+    subsample.  16 and 32 bit integer images are always partitioned
+    '''
+    size = np.size(image)
+    if method == 'subsample':
+        values = sample(image, samples)
+        factor = float(values.size) / size
+        bands = [(int(start * factor), max(int(stop * factor), int(start * factor) + 1)) for start, stop in bands]
+        return band_stats(values, bands)
+    dtype = np.asarray(image).dtype
+    if method == 'histogram' and dtype.kind in 'ui' and dtype.itemsize in (2, 4):
+        # numpy partitions 16 and 32 bit integers faster than they can be binned
+        method = 'exact'
+    if method == 'histogram':
+        counts, centers = histogram(image, bins)
+        after = np.cumsum(counts)
+        before = after - counts
+        stats = []
+        for start, stop in bands:
+            taken = np.clip(np.minimum(after, stop) - np.maximum(before, start), 0, None)
+            mean = np.sum(taken * centers) / (stop - start)
+            stats += [(mean, np.sqrt(np.sum(taken * (centers - mean)**2) / (stop - start)))]
+        return stats
+    if method != 'exact':
+        raise ValueError('unknown method: %s' % method)
+    values = partition(image, [edge for band in bands for edge in band if 0 < edge < size])
+    return [(np.mean(values[start:stop]), np.std(values[start:stop])) for start, stop in bands]
+
+
+def norm(image, minb=0.01, maxb=0.01, nminv=None, nmaxv=None, method='exact', bins=4096):
     image = np.array(image)
     if nminv is None:
         nminv = dtype_min(image.dtype)
@@ -60,15 +160,12 @@ def norm(image, minb=0.01, maxb=0.01, nminv=None, nmaxv=None):
         minb = max(int(minb * image.size), 1)
     if maxb < 1.0:
         maxb = max(int(maxb * image.size), 1)
-    maxb = image.size - np.clip(maxb, 1, image.size-1)
+    maxb = np.clip(maxb, 1, image.size-1)
     minb = np.clip(minb, 1, image.size-1)
-    sorted_values = np.sort(image, axis=None)
     try:
-        ominv = np.mean(sorted_values[:minb])
-        omaxv = np.mean(sorted_values[maxb:])
+        (ominv, _), (omaxv, _) = band_stats(image, [(0, minb), (image.size-maxb, image.size)], method, bins)
     except:
-        print("couldn't get means of:", sorted_values[:minb], sorted_values[maxb:])
-        print( "    :", minb, maxb, image)
+        print("couldn't get means of:", minb, maxb, image)
         ominv = np.min(image.flat)
         omaxv = np.max(image.flat)
     try:
@@ -200,6 +297,20 @@ def resize(image, nrows, ncols):
     return cv2.resize(image, (nrows, ncols), interpolation=interpolation)
 
 
+def bin(image, factor):
+    '''
+    sums `factor` x `factor` blocks over the last two axes by reshaping,
+    rows and columns that do not fill a block are dropped.  on a memory
+    map only the pixels being summed are read
+    '''
+    factor = int(factor)
+    rows = image.shape[-2] // factor
+    cols = image.shape[-1] // factor
+    image = image[..., :rows*factor, :cols*factor]
+    blocks = image.reshape(image.shape[:-2] + (rows, factor, cols, factor))
+    return blocks.sum(axis=(-3, -1), dtype='f4')
+
+
 def zoom(image, factor):
     rows = int(np.round(float(image.shape[-2]) * factor))
     cols = int(np.round(float(image.shape[-1]) * factor))
@@ -1,19 +1,39 @@
 
 import pyfs
 
+from imaging import compressed
+
 # load formatting plugins
 FORMATS = pyfs.loader(pyfs.join(pyfs.dpath(__file__), "formats"))
 
 
+def register(module, names=None):
+    '''
+    registers a format module from outside the formats directory, under
+    the given names or the ones it lists in NAMES
+    '''
+    return FORMATS.register(module, names)
+
+
+def format_of(path):
+    '''
+    the format of a path, looking past a compression extension
+    '''
+    format = pyfs.gext(path, last=True)
+    if format in compressed.EXTENSIONS:
+        format = pyfs.gext(pyfs.rext(path), last=True)
+    return format
+
+
 def save(data, path, format=None, **kwargs):
     if not format:
-        format = pyfs.gext(path, last=True)
+        format = format_of(path)
     return FORMATS[format].save(data, path, **kwargs)
 
 
 def load(path, format=None, **kwargs):
     if not format:
-        format = pyfs.gext(path, last=True)
+        format = format_of(path)
     if format not in FORMATS:
         raise ValueError('file {file!s} is of unknown format'.format(file=path))
     return FORMATS[format].load(path, **kwargs)
@@ -4,16 +4,16 @@ import cv2
 
 from imaging import filters
 
-NAMES = ["png", "jpg", "tiff", "tif"]
+NAMES = ["png", "jpg"]
 
 
 def load(path):
     return cv2.imread(path)
 
 
-def save(image, path, norm=(0.01, 0.01, 0, 255)):
+def save(image, path, norm=(0.01, 0.01, 0, 255), method='subsample'):
     if norm:
-        image = filters.norm(image, *norm)
+        image = filters.norm(image, *norm, method=method)
     with pyfs.shadow(path):
         cv2.imwrite(path, image.astype('uint8'))
     return path
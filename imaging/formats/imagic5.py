@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
+import os
+import time
+
 import pyfs
 import numpy as np
 
+from imaging.stacks import Stack
+
 NAMES = ["hed", "img"]
 
 def UNUSED_WORDS(count):
@@ -10,6 +15,14 @@ def UNUSED_WORDS(count):
 	return ("UNUSED_%d"%UNUSED_WORDS.counter,"%df4"%count)
 UNUSED_WORDS.counter = 0
 
+TYPES = [b"REAL",b"INTG",b"PACK",b"COMP",b"RECO"]
+
+# IMAGIC version written into new headers
+IMAVERS = 20050520
+
+# REALTYPE stamps for little and big endian floats
+REALTYPES = {"<": 33686018, ">": 67372036}
+
 IMAGIC4DHeader = np.dtype([
 	("IMN","i4"),
 	("IFOL","i4"),
@@ -145,23 +158,32 @@ IMAGIC5Header = np.dtype([
 	]) 
 
 def readHeader(fd):
-	header = np.fromfile(fd,dtype=IMAGIC5Header,count=1)[0]
-	if not headerIsSane(header):
-		header = header.byteswap()
-		if not headerIsSane(header):
-			raise ValueError("file is not a valid IMAGIC header")
-	if not checkHeader(header):
-		raise ValueError("type of IMAGIC file is not currently supported")
-	return header
+	'''
+	reads an IMAGIC header, the returned record keeps the byte order of the file
+	'''
+	raw = np.fromfile(fd,dtype=IMAGIC5Header,count=1)
+	if raw.size == 1:
+		for endian in "<>":
+			header = raw.view(IMAGIC5Header.newbyteorder(endian))[0]
+			if headerIsSane(header):
+				checkHeader(header)
+				return header
+	raise ValueError("file is not a valid IMAGIC header")
 
 def headerIsSane(header):
-	return header["TYPE"] in ["REAL","INTG","PACK","COMP","RECO"]
+	return (header["TYPE"] in TYPES and header["IFOL"] >= 0 and
+	        0 < header["ROWS"] < 1 << 20 and 0 < header["COLS"] < 1 << 20)
 
 def checkHeader(header):
-	if header["TYPE"] not in ["REAL"]:
+	if header["TYPE"] not in [b"REAL"]:
 		raise ValueError("type if not supported")
+	if header["IZLP"] > 1:
+		raise ValueError("IMAGIC volumes are not supported")
 	return True
 
+def endianOf(header):
+	return ">" if header.dtype["IMN"].str[0] == ">" else "<"
+
 def show(header):
 	print("-------------------")
 	for field in header.dtype.names:
@@ -171,26 +193,178 @@ def show(header):
 	print("-------------------")
 	return header
 
+class ImagicStack(Stack):
+
+	'''
+	memory mapped IMAGIC-5 stack, the .hed file is mapped as one header
+	record per image next to the images in the .img file
+	'''
+
+	def __init__(self,path,mode="c"):
+		self.path = path
+		with open(pyfs.rext(path,"hed"),"rb") as fd:
+			self.header = readHeader(fd)
+		count = int(self.header["IFOL"]) + 1
+		self.shape = (count,int(self.header["ROWS"]),int(self.header["COLS"]))
+		self.dtype = np.dtype(endianOf(self.header) + "f4")
+		self.headers = np.memmap(pyfs.rext(path,"hed"),dtype=self.header.dtype,mode=mode,shape=(count,))
+		self.data = np.memmap(pyfs.rext(path,"img"),dtype=self.dtype,mode=mode,shape=self.shape)
+
+	def frames(self,start,stop):
+		return self.data[start:stop]
+
 def read(path):
-	with open(pyfs.rext(path,"hed"),"rb") as fd:
-		header = readHeader(fd)
-	with open(pyfs.rext(path,"img"),"r+b") as fd:
-		rows = int(header["ROWS"])
-		cols = int(header["COLS"])
-		count = int(header["IFOL"]+1)
-		data = np.memmap(fd,dtype="f4",mode="c")
-		return data.reshape([count,cols,rows])
-
-def save(data,path):
-	raise NotImplemented
+	return ImagicStack(path)[:]
+
+def load(path,**kwargs):
+	return read(path)
+
+def fillHeaders(headers,images,first):
+	'''
+	fills the header records of a batch of images numbered from `first`,
+	the statistics of every image are computed over the whole batch at once
+	'''
+	count, rows, cols = images.shape
+	axes = (1,2)
+	now = time.localtime()
+	headers["IMN"]      = np.arange(first,first + count)
+	headers["NHFR"]     = 1
+	headers["DATE"]     = (now.tm_mday,now.tm_mon,now.tm_year,now.tm_hour,now.tm_min,now.tm_sec)
+	headers["NPIX2"]    = rows * cols
+	headers["NPIXEL"]   = rows * cols
+	headers["ROWS"]     = rows
+	headers["COLS"]     = cols
+	headers["TYPE"]     = b"REAL"
+	headers["AVDENS"]   = images.mean(axis=axes)
+	headers["SIGMA"]    = images.std(axis=axes)
+	headers["VARIAN"]   = headers["SIGMA"] ** 2
+	headers["DENSMAX"]  = images.max(axis=axes)
+	headers["DENSMIN"]  = images.min(axis=axes)
+	headers["IZLP"]     = 1
+	headers["IMAVERS"]  = IMAVERS
+	headers["REALTYPE"] = REALTYPES[endianOf(headers)]
+	return headers
+
+class ImagicWriter(object):
+
+	'''
+	appends images to an IMAGIC-5 .hed/.img pair in batches, by default to
+	the end of an existing stack.  space for `count` images is allocated up
+	front, per-image headers are filled for a whole batch at once along with
+	any other header fields given per image, and the image count in the
+	first header is updated on close
+	'''
+
+	def __init__(self,path,append=True,count=0):
+		self.path = path
+		self.append_to = append
+		self.reserve = count
+		self.shape = None
+		self.count = 0
+		self.header = IMAGIC5Header
+		self.first = None
+		self.dtype = np.dtype("f4")
+		self.hed = None
+		self.img = None
+
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self,et,ev,tb):
+		self.close()
+		return False
+
+	def open(self):
+		hed, img = pyfs.rext(self.path,"hed"), pyfs.rext(self.path,"img")
+		if self.append_to and os.path.exists(hed) and os.path.getsize(hed) > 0:
+			stack = ImagicStack(self.path,mode="r")
+			self.header, self.dtype = stack.header.dtype, stack.dtype
+			self.shape, self.count = stack.shape[1:], len(stack)
+			self.first = np.array(stack.headers[:1])
+			del stack
+			self.hed, self.img = open(hed,"r+b"), open(img,"r+b")
+		else:
+			self.hed, self.img = open(hed,"wb"), open(img,"wb")
+		self.hed.seek(self.count * self.header.itemsize)
+		if self.shape is not None:
+			self.img.seek(self.count * self.image_bytes)
+			self.allocate()
+		return self
+
+	@property
+	def image_bytes(self):
+		return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+	def allocate(self):
+		'''
+		reserves space on disk for the images still to be appended
+		'''
+		if not self.reserve:
+			return
+		total = self.count + self.reserve
+		for fd, size in [(self.hed,total * self.header.itemsize),(self.img,total * self.image_bytes)]:
+			if hasattr(os,"posix_fallocate"):
+				os.posix_fallocate(fd.fileno(),0,size)
+			elif os.fstat(fd.fileno()).st_size < size:
+				fd.truncate(size)
+
+	def append(self,images,**fields):
+		'''
+		appends a 2D image or a batch of images.  other header fields can
+		be given with a value per image, e.g. SHIFT=shifts for (N, 2) shifts
+		'''
+		images = np.asarray(images,dtype="f4")
+		if images.ndim == 2:
+			images = images[np.newaxis]
+		if images.ndim != 3:
+			raise ValueError("expected an image or a batch of images, got shape: %s" % (images.shape,))
+		if self.shape is None:
+			self.shape = images.shape[1:]
+			self.allocate()
+		elif images.shape[1:] != self.shape:
+			raise ValueError("image shape %s does not match stack shape %s" % (images.shape[1:],self.shape))
+		headers = fillHeaders(np.zeros(len(images),dtype=self.header),images,self.count + 1)
+		for field, values in fields.items():
+			headers[field] = values
+		if self.first is None:
+			self.first = headers[:1].copy()
+		headers.tofile(self.hed)
+		images.astype(self.dtype,copy=False).tofile(self.img)
+		self.count += len(images)
+		return self
+
+	def close(self):
+		if self.hed is None:
+			return
+		try:
+			self.hed.truncate(self.count * self.header.itemsize)
+			self.img.truncate(self.count * self.image_bytes if self.shape else 0)
+			if self.first is not None:
+				self.first["IFOL"] = self.count - 1
+				self.first["I4LP"] = self.count
+				self.hed.seek(0)
+				self.first.tofile(self.hed)
+		finally:
+			self.hed.close()
+			self.img.close()
+			self.hed = self.img = None
+
+def save(data,path,**fields):
+	'''
+	saves an image or a stack as an IMAGIC-5 .hed/.img pair
+	'''
+	data = np.asarray(data)
+	with ImagicWriter(path,append=False,count=len(data) if data.ndim == 3 else 1) as dst:
+		dst.append(data,**fields)
+	return path
 
 if __name__ == "__main__":
 	import sys
 	import spider
 	import filters
 	stack = read(sys.argv[1])
-	for i, image in enumerate(stack):
-		image = filters.resize(image,[32,32])
-		spider.save(image,"particles/%d.spi"%i)
+	with spider.SpiderWriter("particles.spi",append=False) as dst:
+		for image in stack:
+			dst.append(filters.resize(image,[32,32]))
 	
 
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
+import io
+import os
+from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from imaging import filters
+import imaging
+from imaging import compressed
+from imaging.stacks import Stack, CHUNK_FRAMES
 
 np.seterr(all='raise')
 
@@ -39,48 +46,248 @@ MRCHeader = np.dtype([
     ("labels", "10a80")
 ])
 
+# SerialEM writes 4-bit data two pixels to a byte, either as mode 101
+# or as mode 0 with the IMOD 4-bit flag set and nx counting bytes
+PACKED_MODE = 101
+IMOD_STAMP = 1146047817
+IMOD_STAMP_WORD = 14
+IMOD_FLAGS_WORD = 15
+IMOD_FLAG_4BIT = 16
+
+
+def read_header(fd):
+    '''
+    reads the header from an open MRC file and returns it along with the
+    byte order of the file, the header fields are viewed in that byte order
+    '''
+    header = np.frombuffer(fd.read(MRCHeader.itemsize), dtype=MRCHeader).copy()
+    if header.size != 1:
+        raise ValueError('file is too small to be an MRC')
+    for endian in '<>':
+        swapped = header.view(MRCHeader.newbyteorder(endian))[0]
+        if swapped['mode'] in MRCModes or swapped['mode'] == PACKED_MODE:
+            return swapped, endian
+    raise ValueError('unknown MRC type')
+
+
+def is_packed(header):
+    if header['mode'] == PACKED_MODE:
+        return True
+    return (header['mode'] == 0 and
+            header['extra'][IMOD_STAMP_WORD] == IMOD_STAMP and
+            bool(header['extra'][IMOD_FLAGS_WORD] & IMOD_FLAG_4BIT))
+
+
+def unpack4(packed, width=None, out=None):
+    '''
+    unpacks rows of 4-bit pixels stored two to a byte, low nibble first
+    '''
+    if width is None:
+        width = packed.shape[-1] * 2
+    if out is None:
+        out = np.empty(packed.shape[:-1] + (width,), dtype='u1')
+    np.bitwise_and(packed[..., :(width + 1) // 2], 15, out=out[..., 0::2])
+    np.right_shift(packed[..., :width // 2], 4, out=out[..., 1::2])
+    return out
+
+
+class MrcStack(Stack):
+
+    '''
+    lazy view of an MRC stack.  the header is parsed once and frames are
+    memory mapped only as they are indexed, so pulling a single frame out
+    of a large movie never maps or byte-swaps the rest of the file.
+    4-bit packed stacks are unpacked to bytes as frames are pulled.
+    compressed stacks are decompressed into memory on a background thread
+    only as far as the frames pulled so far, plus the readahead
+    '''
+
+    def __init__(self, path, mode='c', readahead=1, threads=None):
+        self.path = path
+        self.mode = mode
+        self.readahead = readahead
+        self.inflater = None
+        self.header, self.endian = read_header(open_header(path))
+        self.offset = MRCHeader.itemsize + int(self.header['extended_header'])
+        self.packed = is_packed(self.header)
+        nx, ny, nz = [int(dim) for dim in self.header['dims']]
+        if not self.packed:
+            self.dtype = MRCModes[int(self.header['mode'])].newbyteorder(self.endian)
+            self.shape = self.raw_shape = (nz, ny, nx)
+        elif self.header['mode'] == PACKED_MODE:
+            self.dtype = np.dtype('u1')
+            self.shape = (nz, ny, nx)
+            self.raw_shape = (nz, ny, (nx + 1) // 2)
+        else:
+            self.dtype = np.dtype('u1')
+            self.shape = (nz, ny, nx * 2)
+            self.raw_shape = (nz, ny, nx)
+        if compressed.is_compressed(path):
+            self.buffer = np.empty(self.raw_shape, dtype=self.dtype)
+            self.inflater = compressed.Inflater(path, self.offset, self.buffer,
+                                                readahead=max(1, readahead) * CHUNK_FRAMES * self.frame_bytes,
+                                                threads=threads)
+
+    def __del__(self):
+        if getattr(self, 'inflater', None) is not None:
+            self.inflater.close()
+
+    @property
+    def frame_bytes(self):
+        return int(np.prod(self.raw_shape[1:])) * self.dtype.itemsize
+
+    def raw(self, start, stop):
+        '''
+        memory maps the frames in [start, stop) as they are stored on disk
+        '''
+        if stop <= start:
+            return np.empty((0,) + self.raw_shape[1:], dtype=self.dtype)
+        if self.inflater is not None:
+            self.inflater.fill(stop * self.frame_bytes)
+            return self.buffer[start:stop]
+        return np.memmap(self.path, mode=self.mode, dtype=self.dtype,
+                         offset=self.offset + start * self.frame_bytes,
+                         shape=(stop - start,) + self.raw_shape[1:])
+
+    def frames(self, start, stop):
+        '''
+        memory maps the frames in [start, stop), packed frames are unpacked
+        '''
+        if self.packed:
+            return unpack4(self.raw(start, stop), self.shape[-1])
+        return self.raw(start, stop)
+
+    def prefetch(self, start, stop):
+        if self.inflater is not None:
+            self.inflater.request(stop * self.frame_bytes)
+            return
+        if stop <= start or not hasattr(os, 'posix_fadvise'):
+            return
+        with open(self.path, 'rb') as fd:
+            os.posix_fadvise(fd.fileno(),
+                             self.offset + start * self.frame_bytes,
+                             (stop - start) * self.frame_bytes,
+                             os.POSIX_FADV_WILLNEED)
+
 
 def load(path, supress=False, norm=False):
-    endian = '<'
-    with open(path, "rb") as fd:
-        header = np.fromfile(fd, dtype=MRCHeader, count=1)[0]
-        header = header.newbyteorder(endian)
-        # memory map using copy on write mode
-        # with offset starting after the header
-        # and reverse dimensions from header
-        if header["mode"] not in MRCModes:
-            endian = '>'
-            header = header.newbyteorder(endian)
-        data = np.memmap(fd, mode="c",
-                           offset=MRCHeader.itemsize + header['extended_header'],
-                            dtype=MRCModes[header["mode"]],
-                            shape=tuple(header["dims"][::-1]))
-        data = data.newbyteorder(endian)
-        if supress:
-            data = filters.supress(data, *supress)
-        if norm:
-            data = filters.norm(data, *norm)
-        return data
+    data = MrcStack(path)[:]
+    if supress:
+        data = imaging.filters.supress(data, *supress)
+    if norm:
+        data = imaging.filters.norm(data, *norm)
+    return data
+
+
+def open_header(path):
+    '''
+    file-like object holding the header bytes of a plain or compressed MRC
+    '''
+    if compressed.is_compressed(path):
+        return io.BytesIO(compressed.head(path, MRCHeader.itemsize))
+    with open(path, 'rb') as fd:
+        return io.BytesIO(fd.read(MRCHeader.itemsize))
 
 
 def load_header(path):
-    with open(path, "rb") as fd:
-        header = np.fromfile(fd, dtype=MRCHeader, count=1)[0]
-        if header["mode"] not in MRCModes:
-            header = header.byteswap()
-        if header["mode"] not in MRCModes:
-            raise ValueError('unknown MRC type')
-        return header
+    return read_header(open_header(path))[0]
+
+
+SCAN_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'imaging', 'mrc-headers.npy')
+
+
+def scan_dtype(length):
+    return np.dtype([
+        ("path", "U%d" % max(length, 1)),
+        ("size", "i8"),
+        ("mtime", "f8"),
+        ("valid", "?"),
+        ("header", MRCHeader),
+    ])
+
+
+def scan(paths, threads=None, cache=SCAN_CACHE):
+    '''
+    reads the headers of many MRC files on a thread pool into a single
+    structured array.  headers are cached on disk keyed by path, size and
+    mtime so rescanning a session only opens files that have changed.
+    files that can't be read are kept with `valid` set to False
+    '''
+    paths = [os.path.abspath(path) for path in paths]
+    cached = load_scan_cache(cache)
+
+    def read(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path, -1, 0.0, False, None
+        entry = cached.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return path, stat.st_size, stat.st_mtime, True, entry['header']
+        try:
+            return path, stat.st_size, stat.st_mtime, True, load_header(path)
+        except (IOError, ValueError):
+            return path, stat.st_size, stat.st_mtime, False, None
+
+    with ThreadPoolExecutor(threads or 4 * os.cpu_count()) as pool:
+        results = list(pool.map(read, paths))
+
+    index = np.zeros(len(paths), dtype=scan_dtype(max([len(path) for path in paths] or [1])))
+    for entry, (path, size, mtime, valid, header) in zip(index, results):
+        entry['path'] = path
+        entry['size'] = size
+        entry['mtime'] = mtime
+        entry['valid'] = valid
+        if header is not None:
+            entry['header'] = header
+    if cache:
+        save_scan_cache(cache, index, cached)
+    return index
 
 
-def header_from_array(array):
+def load_scan_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        entries = np.load(path)
+    except (IOError, ValueError):
+        return {}
+    return {str(entry['path']): entry for entry in entries}
+
+
+def save_scan_cache(path, index, cached):
+    entries = dict(cached)
+    for entry in index[index['valid']]:
+        entries[str(entry['path'])] = entry
+    length = max([len(key) for key in entries] or [1])
+    merged = np.array([tuple(entry) for entry in entries.values()], dtype=scan_dtype(length))
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmppath, 'wb') as dst:
+            np.save(dst, merged)
+        os.replace(tmppath, path)
+    except (IOError, OSError):
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+def mode_from_dtype(dtype):
+    dtype = np.dtype(dtype)
+    dtype = np.dtype('%s%d' % (dtype.kind, dtype.itemsize))
+    modes = {MRCModes[k]: k for k in MRCModes}
+    if dtype not in modes:
+        raise ValueError('no MRC mode for data type: %s' % dtype)
+    return modes[dtype]
+
+
+def header_from_shape(shape, dtype):
     header = np.zeros([1], dtype=MRCHeader)
-    dtype = np.dtype('%s%d' % (array.dtype.kind, array.dtype.itemsize))
-    header[0]['mode'] = {MRCModes[k]: k for k in MRCModes}[dtype]
-    shape = list(array.shape)
-    if array.ndim == 2:
+    header[0]['mode'] = mode_from_dtype(dtype)
+    shape = list(shape)
+    if len(shape) == 2:
         shape = [1] + shape
-    elif array.ndim == 4 and array.shape[1] == 1:
+    elif len(shape) == 4 and shape[1] == 1:
         shape = shape[0:1] + shape[2:]
     header[0]['dims'][:] = shape[::-1]
     header[0]['intervals'][:] = header[0]['dims']
@@ -89,6 +296,13 @@ def header_from_array(array):
     return header
 
 
+def header_from_array(array, stats=False, threads=None):
+    header = header_from_shape(array.shape, array.dtype)
+    if stats:
+        moments(array, threads=threads).fill(header[0])
+    return header
+
+
 def header_from_dims(dims):
     header = np.zeros([1], dtype=MRCHeader)
     dtype = np.dtype('f4')
@@ -102,12 +316,297 @@ def header_from_dims(dims):
     return header
 
 
+class Moments(object):
+
+    '''
+    running count, min, max, mean and variance of a data stream.  chunks
+    are summarized on their own and merged with the pairwise update of
+    Chan et al. so the mean and variance stay stable over long streams
+    '''
+
+    def __init__(self, count=0, min=np.inf, max=-np.inf, mean=0.0, m2=0.0):
+        self.count = count
+        self.min = min
+        self.max = max
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, data):
+        data = np.asarray(data)
+        if data.size == 0:
+            return cls()
+        mean = np.mean(data, dtype='f8')
+        m2 = np.sum(np.square(data - mean, dtype='f8'))
+        return cls(data.size, float(np.min(data)), float(np.max(data)), float(mean), float(m2))
+
+    @classmethod
+    def of_header(cls, header):
+        '''
+        moments from the statistics stored in an MRC header, None when the
+        header has none
+        '''
+        if not (header['max'] > header['min'] and header['stdev'] > 0):
+            return None
+        count = int(np.prod(header['dims'], dtype='i8'))
+        return cls(count, float(header['min']), float(header['max']),
+                   float(header['mean']), float(header['stdev']) ** 2 * count)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * (float(other.count) / count)
+        m2 = self.m2 + other.m2 + delta * delta * (float(self.count) * other.count / count)
+        return Moments(count, min(self.min, other.min), max(self.max, other.max), mean, m2)
+
+    @property
+    def stdev(self):
+        if self.count == 0:
+            return 0.0
+        return float(np.sqrt(self.m2 / self.count))
+
+    def fill(self, header):
+        if self.count == 0:
+            return header
+        header['min'] = self.min
+        header['max'] = self.max
+        header['mean'] = self.mean
+        header['stdev'] = self.stdev
+        return header
+
+
+def blocks(data, count):
+    '''
+    splits an array into at most `count` row blocks without copying
+    '''
+    data = np.asarray(data)
+    if data.ndim > 1 and data.flags.c_contiguous:
+        data = data.reshape(-1, data.shape[-1])
+    count = max(1, min(count, len(data) // 64))
+    return np.array_split(data, count)
+
+
+def moments(data, threads=None, pool=None):
+    '''
+    single pass moments of an array, summarized block-wise on a thread pool
+    '''
+    threads = threads or os.cpu_count()
+    if pool is None:
+        with ThreadPoolExecutor(threads) as pool:
+            return moments(data, threads, pool)
+    parts = pool.map(Moments.of, blocks(data, threads))
+    return reduce(Moments.merge, parts, Moments())
+
+
+def restat(path, threads=None, chunk=8):
+    '''
+    recomputes the min, max, mean and stdev of an MRC file over a read-only
+    memory map and patches them into the header in place
+    '''
+    if compressed.is_compressed(path):
+        raise ValueError('can not patch the header of compressed file: %s' % path)
+    threads = threads or os.cpu_count()
+    stack = MrcStack(path, mode='r')
+    total = Moments()
+    with ThreadPoolExecutor(threads) as pool:
+        for frames in stack.chunks(chunk):
+            total = total.merge(moments(frames, threads, pool))
+    header = total.fill(stack.header.copy())
+    with open(path, 'r+b') as fd:
+        np.array([header], dtype=header.dtype).tofile(fd)
+    return header
+
+
+class MrcWriter(object):
+
+    '''
+    incrementally writes an MRC stack.  a placeholder header is written
+    when opened, frames or chunks of frames are appended as they arrive
+    and the dimensions and statistics are patched into the header on close.
+    statistics of each chunk are computed on a thread pool while it is
+    being written out
+    '''
+
+    def __init__(self, path, dtype=None, threads=None):
+        self.path = path
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.threads = threads or os.cpu_count()
+        self.shape = None
+        self.count = 0
+        self.moments = Moments()
+        self.pool = None
+        self.fd = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, et, ev, tb):
+        self.close()
+        return False
+
+    def open(self):
+        self.fd = open(self.path, 'wb')
+        self.pool = ThreadPoolExecutor(self.threads)
+        np.zeros([1], dtype=MRCHeader).tofile(self.fd)
+        return self
+
+    def write(self, frames):
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        elif frames.ndim == 4 and frames.shape[1] == 1:
+            frames = frames[:, 0]
+        if frames.ndim != 3:
+            raise ValueError('expected a frame or a stack of frames, got shape: %s' % (frames.shape,))
+        if self.shape is None:
+            self.shape = frames.shape[1:]
+            if self.dtype is None:
+                self.dtype = frames.dtype
+            # headers are written little endian, so the data has to be too
+            self.dtype = np.dtype(self.dtype).newbyteorder('<')
+            mode_from_dtype(self.dtype)
+        elif frames.shape[1:] != self.shape:
+            raise ValueError('frame shape %s does not match stack shape %s' % (frames.shape[1:], self.shape))
+        frames = frames.astype(self.dtype, copy=False)
+        parts = []
+        if self.dtype.kind in 'uif':
+            parts = [self.pool.submit(Moments.of, block) for block in blocks(frames, self.threads)]
+        frames.tofile(self.fd)
+        for part in parts:
+            self.moments = self.moments.merge(part.result())
+        self.count += len(frames)
+        return self
+
+    def header(self):
+        shape = (self.count,) + (self.shape or (0, 0))
+        header = header_from_shape(shape, self.dtype or np.dtype('f4'))
+        self.moments.fill(header[0])
+        return header
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.fd.seek(0)
+            self.header().tofile(self.fd)
+        finally:
+            self.pool.shutdown()
+            self.fd.close()
+            self.fd = None
+
+
 def save(image, path):
-    image = np.array(image)
-    with open(path, 'wb') as dst:
-        header = header_from_array(image)
-        header.tofile(dst)
-        image.tofile(dst)
+    with MrcWriter(path) as dst:
+        dst.write(image)
+
+
+def merge(paths, dst, threads=None, cache=None):
+    '''
+    concatenates MRC files, such as the per-frame files of a movie, into one
+    stack.  every header is checked for the frame size and mode of the first
+    before the output is allocated once, then each file's frames are copied
+    into place by offset on a thread pool.  statistics are merged from the
+    input headers, files without them are summarized as they are copied
+    '''
+    threads = threads or os.cpu_count()
+    index = scan(paths, threads=threads, cache=cache)
+    if len(index) == 0:
+        raise ValueError('no MRC files to merge')
+    for entry in index:
+        if not entry['valid']:
+            raise ValueError('can not read the MRC header of %s' % entry['path'])
+    headers = index['header']
+    packed = [is_packed(header) for header in headers]
+    for entry, header, flag in zip(index, headers, packed):
+        if (np.any(header['dims'][:2] != headers[0]['dims'][:2]) or
+                header['mode'] != headers[0]['mode'] or flag != packed[0]):
+            raise ValueError('%s does not match the frame size and mode of %s' % (entry['path'], index[0]['path']))
+    counts = headers['dims'][:, 2].astype('i8')
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    first = MrcStack(paths[0], mode='r')
+    header = np.array([first.header], dtype=first.header.dtype)
+    header[0]['dims'][2] = starts[-1]
+    if header[0]['intervals'][2] > 0:
+        header[0]['lengths'][2] *= float(starts[-1]) / header[0]['intervals'][2]
+    header[0]['intervals'][2] = starts[-1]
+    header[0]['extended_header'] = 0
+    out = np.memmap(dst, mode='w+', dtype=first.dtype, offset=MRCHeader.itemsize,
+                    shape=(int(starts[-1]),) + first.raw_shape[1:])
+
+    def copy(idx):
+        stack = MrcStack(paths[idx], mode='r')
+        frames = out[starts[idx]:starts[idx + 1]]
+        frames[...] = stack.raw(0, len(stack))
+        total = Moments.of_header(headers[idx])
+        if total is None and not stack.packed:
+            total = Moments.of(frames)
+        return total
+
+    with ThreadPoolExecutor(threads) as pool:
+        parts = list(pool.map(copy, range(len(paths))))
+    out.flush()
+    del out
+    for field in ('min', 'max', 'mean', 'stdev'):
+        header[0][field] = 0
+    if all(part is not None for part in parts):
+        reduce(Moments.merge, parts, Moments()).fill(header[0])
+    with open(dst, 'r+b') as fd:
+        header.tofile(fd)
+    return dst
 
 
+def unpack(src, dst, dtype='u1', scale=1, threads=None, chunk=4):
+    '''
+    unpacks a 4-bit packed stack, chunks of frames are unpacked in parallel
+    straight into a memory mapped destination stack.  values are multiplied
+    by `scale`, as `clip unpack -n` does
+    '''
+    threads = threads or os.cpu_count()
+    stack = MrcStack(src, mode='r')
+    if not stack.packed:
+        raise ValueError('%s is not a 4-bit packed stack' % src)
+    header = header_like(stack, dtype)
+    dst_data = np.memmap(dst, mode='w+', dtype=dtype,
+                         offset=MRCHeader.itemsize, shape=stack.shape)
 
+    def unpack_chunk(start):
+        stop = min(start + chunk, len(stack))
+        out = dst_data[start:stop]
+        unpack4(stack.raw(start, stop), stack.shape[-1], out=out)
+        if scale != 1:
+            np.multiply(out, scale, out=out, casting='unsafe')
+        return Moments.of(out)
+
+    with ThreadPoolExecutor(threads) as pool:
+        total = reduce(Moments.merge, pool.map(unpack_chunk, range(0, len(stack), chunk)), Moments())
+    dst_data.flush()
+    del dst_data
+    total.fill(header[0])
+    with open(dst, 'r+b') as fd:
+        header.tofile(fd)
+    return dst
+
+
+def header_like(stack, dtype, shape=None, binning=1):
+    '''
+    header for a stack derived from another, such as its unpacked or gain
+    normalized version.  keeps the pixel size, origin and labels of the
+    original and drops the extended header.  a binned stack of `shape` has
+    its pixels `binning` times larger along the rows and columns
+    '''
+    src = stack.header
+    header = header_from_shape(stack.shape if shape is None else shape, dtype)
+    for field in ('start', 'angles', 'mapping', 'origin', 'type', 'stamp', 'nlabels', 'labels'):
+        header[0][field] = src[field]
+    intervals = np.array(src['intervals'], dtype='f4')
+    if np.all(intervals > 0):
+        apix = np.array(src['lengths'], dtype='f4') / intervals
+        apix[:2] *= binning
+        header[0]['lengths'] = apix * header[0]['dims']
+    header[0]['extra'] = src['extra']
+    header[0]['extra'][IMOD_FLAGS_WORD] &= ~IMOD_FLAG_4BIT
+    return header
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
+import os
+
 import numpy as np
 
-from imaging import filters
+import imaging
+from imaging.stacks import Stack
 
 NAMES = ["spi", "xmp"]
 
@@ -10,8 +13,8 @@ def lenbyt(cols):
 	return int(cols) * 4
 
 def labrec(cols):
-	labrec = int(256/int(cols)) + 1
-	if labrec == 0:
+	labrec = 256 // int(cols)
+	if 256 % int(cols):
 		labrec += 1
 	return labrec
 
@@ -29,7 +32,7 @@ SpiderHeader = np.dtype([
 	("IREC","f4"),
 	UNUSED_CARDS(1),
 	("IFORM","f4"),
-	("IMAMI","i4"),
+	("IMAMI","f4"),
 	("FMAX","f4"),
 	("FMIN","f4"),
 	("AV","f4"),
@@ -37,7 +40,7 @@ SpiderHeader = np.dtype([
 	UNUSED_CARDS(1),
 	("NX","f4"),
 	("LABREC","f4"),
-	("IANGLE","i4"),
+	("IANGLE","f4"),
 	("PHI","f4"),
 	("THETA","f4"),
 	("GAMMA","f4"),
@@ -47,7 +50,7 @@ SpiderHeader = np.dtype([
 	("SCALE","f4"),
 	("LABBYT","f4"),
 	("LENBYT","f4"),
-	("ISTACK","i4"),
+	("ISTACK","f4"),
 	UNUSED_CARDS(1),
 	("MAXIM","f4"),
 	("IMGNUM","f4"),
@@ -79,15 +82,20 @@ SpiderHeader = np.dtype([
 	]) 
 
 def readHeader(fd):
-	header = np.fromfile(fd,dtype=SpiderHeader,count=1)[0]
-	if not headerIsSane(header):
-		header = header.byteswap()
-		if not headerIsSane(header):
-			raise ValueError("file is not a spider image")
-	return header
+	'''
+	reads a spider header, the returned record keeps the byte order of the file
+	'''
+	raw = np.fromfile(fd,dtype=SpiderHeader,count=1)
+	if raw.size == 1:
+		for endian in "<>":
+			header = raw.view(SpiderHeader.newbyteorder(endian))[0]
+			if headerIsSane(header):
+				return header
+	raise ValueError("file is not a spider image")
 
 def headerIsSane(header):
-	return int(header["LABBYT"]) == labbyt(header["NX"]) 
+	nx, ny, nz, records, length = [float(header[key]) for key in ("NX","NY","NZ","LABREC","LABBYT")]
+	return nx >= 1 and ny >= 1 and nz >= 1 and length >= 1024 and length == records * nx * 4
 
 def show(header):
 	print("-------------------")
@@ -97,58 +105,215 @@ def show(header):
 	print("-------------------")
 	return header
 
-def load(path,norm=False,supress=False):
-	with open(path,"rb") as fd:
-		header = readHeader(fd)
-		fd.seek(int(header["LABBYT"]))
-		rows = int(header["NX"])
-		cols = int(header["NY"])
-		if int(header["NZ"]) != 1:
-			raise ValueError("spider volumes not supported")
-		if int(header["ISTACK"]) != 0:
-			raise ValueError("spider stacks not supported")
-		data = np.fromfile(fd,dtype="f4")
-		if data.size != rows*cols:
+def imageShape(header):
+	nz, ny, nx = [int(header[key]) for key in ("NZ","NY","NX")]
+	if nz > 1:
+		return (nz,ny,nx)
+	return (ny,nx)
+
+def recordType(header):
+	'''
+	the layout of one image in a file: its header padded out to LABBYT
+	followed by its data, in the byte order of the header
+	'''
+	length = int(header["LABBYT"])
+	shape = imageShape(header)
+	return np.dtype({
+		"names": ["header","data"],
+		"formats": [header.dtype,(header.dtype["NX"],shape)],
+		"offsets": [0,length],
+		"itemsize": length + 4 * int(np.prod(shape)),
+	})
+
+class SpiderStack(Stack):
+
+	'''
+	memory mapped spider image, volume or stack.  every image is read as one
+	record of its header and data, so any image of a stack and its header
+	are found by index without reading the rest of the file
+	'''
+
+	def __init__(self,path,mode="c"):
+		self.path = path
+		with open(path,"rb") as fd:
+			self.header = readHeader(fd)
+		istack = int(self.header["ISTACK"])
+		if istack < 0:
+			raise ValueError("indexed spider stacks not supported")
+		self.stacked = istack > 0
+		self.record = recordType(self.header)
+		self.offset, count = 0, 1
+		if self.stacked:
+			self.offset, count = int(self.header["LABBYT"]), int(self.header["MAXIM"])
+		if os.path.getsize(path) < self.offset + count * self.record.itemsize:
 			raise ValueError("spider image has bad/incomplete data")
-		if supress:
-			data = filters.supress(data,*supress)
-		if norm:
-			data = filters.norm(data,*norm)
-		return data.reshape([cols,rows])
+		if count > 0:
+			self.records = np.memmap(path,dtype=self.record,mode=mode,offset=self.offset,shape=(count,))
+		else:
+			self.records = np.zeros(0,dtype=self.record)
+		self.shape = (count,) + imageShape(self.header)
+		self.dtype = self.record["data"].base
+
+	@property
+	def headers(self):
+		'''
+		per-image headers, for a single image or volume this is the file header
+		'''
+		return self.records["header"]
+
+	def frames(self,start,stop):
+		return self.records["data"][start:stop]
+
+	def prefetch(self,start,stop):
+		if stop <= start or not hasattr(os,"posix_fadvise"):
+			return
+		with open(self.path,"rb") as fd:
+			os.posix_fadvise(fd.fileno(),
+			                 self.offset + start * self.record.itemsize,
+			                 (stop - start) * self.record.itemsize,
+			                 os.POSIX_FADV_WILLNEED)
+
+def load(path,norm=False,supress=False):
+	stack = SpiderStack(path)
+	data = stack[:] if stack.stacked else stack[0]
+	if supress:
+		data = imaging.filters.supress(data,*supress)
+	if norm:
+		data = imaging.filters.norm(data,*norm)
+	return data
+
+def fillHeaders(headers,shape):
+	'''
+	sets the dimensions in an array of headers for images of the given shape
+	'''
+	nz, ny, nx = (1,) * (3 - len(shape)) + tuple(shape)
+	headers["IFORM"]  = 3 if len(shape) == 3 else 1
+	headers["NZ"]     = nz
+	headers["NY"]     = ny
+	headers["NX"]     = nx
+	headers["SCALE"]  = 1
+	headers["LABREC"] = labrec(nx)
+	headers["LABBYT"] = labbyt(nx)
+	headers["LENBYT"] = lenbyt(nx)
+	headers["IMAMI"]  = 0
+	headers["SIG"]    = -1
+	return headers
+
+def fillStats(headers,images):
+	'''
+	sets the statistics of each image in a batch into its header
+	'''
+	axes = tuple(range(1,images.ndim))
+	headers["IMAMI"] = 1
+	headers["SIG"]   = images.std(axis=axes)
+	headers["FMAX"]  = images.max(axis=axes)
+	headers["FMIN"]  = images.min(axis=axes)
+	headers["AV"]    = images.mean(axis=axes)
+	return headers
 
 def formHeader(image,compute_stats=False):
 
-	if (image.ndim,image.dtype.kind,image.dtype.itemsize) != (2,"f",4):
-		raise ValueError("only spider simple images are supported")	
-	
-	header = np.zeros(1,dtype=SpiderHeader)[0]
-	
-	header["IFORM"]  = 1
-	header["NZ"]     = 1
-	header["NY"]     = image.shape[-2]
-	header["NX"]     = image.shape[-1]
-	header["SCALE"]  = 1
-	header["LABREC"] = labrec(image.shape[-1])
-	header["LABBYT"] = labbyt(image.shape[-1])
-	header["LENBYT"] = lenbyt(image.shape[-1])
-
-	header["IMAMI"] = 0
-	header["SIG"]   = -1
+	if (image.ndim,image.dtype.kind,image.dtype.itemsize) not in [(2,"f",4),(3,"f",4)]:
+		raise ValueError("only spider images and volumes are supported")
+
+	headers = fillHeaders(np.zeros(1,dtype=SpiderHeader),image.shape)
 	if compute_stats:
-		header["IMAMI"] = 1
-		header["SIG"] = np.std(image)
-		header["FMAX"] = np.max(image)
-		header["FMIN"] = np.min(image)
-		header["AV"]   = np.mean(image)
+		fillStats(headers,image[np.newaxis])
+	return headers[0]
 
-	return header
+class SpiderWriter(object):
+
+	'''
+	appends images to a spider stack, by default to the end of an existing
+	stack.  each batch of images is written as records of per-image headers
+	and data, and the image count in the stack header is updated on close
+	'''
+
+	def __init__(self,path,append=True,compute_stats=False):
+		self.path = path
+		self.append_to = append
+		self.compute_stats = compute_stats
+		self.headers = None
+		self.record = None
+		self.count = 0
+		self.fd = None
 
-def save(image, path, compute_stats=False, **kwargs):
-	image = image.astype("f4")
-	with open(path,"wb") as fd:
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self,et,ev,tb):
+		self.close()
+		return False
+
+	def open(self):
+		if self.append_to and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+			stack = SpiderStack(self.path,mode="r")
+			if not stack.stacked:
+				raise ValueError("file {file!s} is not a spider stack".format(file=self.path))
+			self.headers = np.array([stack.header],dtype=stack.header.dtype)
+			self.record = stack.record
+			self.count = len(stack)
+			del stack
+			self.fd = open(self.path,"r+b")
+			self.fd.seek(int(self.headers[0]["LABBYT"]) + self.count * self.record.itemsize)
+			self.fd.truncate()
+		else:
+			self.fd = open(self.path,"wb")
+		return self
+
+	def append(self,images):
+		'''
+		appends a 2D image or a batch of images, a batch of volumes is 4D
+		'''
+		images = np.asarray(images,dtype="f4")
+		if images.ndim == 2:
+			images = images[np.newaxis]
+		if images.ndim not in (3,4):
+			raise ValueError("expected an image or a batch of images, got shape: %s" % (images.shape,))
+		if self.headers is None:
+			self.headers = fillHeaders(np.zeros(1,dtype=SpiderHeader),images.shape[1:])
+			self.headers["ISTACK"] = 2
+			self.record = recordType(self.headers[0])
+			self.headers.tofile(self.fd)
+			self.fd.seek(int(self.headers[0]["LABBYT"]))
+		shape = imageShape(self.headers[0])
+		if images.shape[1:] != shape:
+			raise ValueError("image shape %s does not match stack shape %s" % (images.shape[1:],shape))
+		records = np.zeros(len(images),dtype=self.record)
+		headers = fillHeaders(records["header"],shape)
+		headers["IMGNUM"] = np.arange(self.count + 1,self.count + len(images) + 1)
+		if self.compute_stats:
+			fillStats(headers,images)
+		records["data"] = images
+		records.tofile(self.fd)
+		self.count += len(images)
+		return self
+
+	def close(self):
+		if self.fd is None:
+			return
+		try:
+			if self.headers is not None:
+				self.headers["MAXIM"] = self.count
+				self.fd.seek(0)
+				self.headers.tofile(self.fd)
+		finally:
+			self.fd.close()
+			self.fd = None
+
+def save(image, path, compute_stats=False, volume=False, **kwargs):
+	'''
+	saves a 2D image, or a volume when `volume` is set.  anything else is
+	saved as a stack of its first axis
+	'''
+	image = np.asarray(image).astype("f4")
+	if image.ndim == 2 or (volume and image.ndim == 3):
 		header = formHeader(image,compute_stats=compute_stats)
-		header.tofile(fd)
-		fd.seek(int(header["LABBYT"]))
-		image.tofile(fd)
+		record = np.zeros(1,dtype=recordType(header))
+		record["header"] = header
+		record["data"] = image
+		record.tofile(path)
 		return path
-
+	with SpiderWriter(path,append=False,compute_stats=compute_stats) as dst:
+		dst.append(image)
+	return path
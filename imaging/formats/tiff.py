@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import os
+import mmap
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numba import jit
+
+from imaging.stacks import Stack
+
+NAMES = ["tif", "tiff"]
+
+# tag ids
+WIDTH = 256
+LENGTH = 257
+BITS = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTES = 279
+PREDICTOR = 317
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+TAGS = (WIDTH, LENGTH, BITS, COMPRESSION, STRIP_OFFSETS, SAMPLES,
+        ROWS_PER_STRIP, STRIP_BYTES, PREDICTOR, TILE_WIDTH, SAMPLE_FORMAT)
+
+# tag type ids to struct codes, rationals are read as pairs of ints
+TYPES = {
+    1: 'B', 3: 'H', 4: 'I', 5: 'I', 6: 'b', 7: 'B', 8: 'h',
+    9: 'i', 10: 'i', 11: 'f', 12: 'd', 16: 'Q', 17: 'q', 18: 'Q',
+}
+RATIONALS = (5, 10)
+
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+NONE = 1
+LZW = 5
+DEFLATE = (8, 32946)
+
+
+@jit(nopython=True, nogil=True)
+def lzw_decode(src, dst):
+    '''
+    decodes a TIFF LZW strip (MSB first codes with early change) into dst
+    and returns the number of bytes written
+    '''
+    prefix = np.empty(4096, dtype=np.int32)
+    suffix = np.empty(4096, dtype=np.uint8)
+    length = np.empty(4096, dtype=np.int32)
+    for code in range(256):
+        prefix[code] = -1
+        suffix[code] = code
+        length[code] = 1
+    nbits = src.size * 8
+    bitpos = 0
+    width = 9
+    next_code = 258
+    old = -1
+    pos = 0
+    while bitpos + width <= nbits:
+        byte = bitpos >> 3
+        chunk = np.int64(src[byte]) << 16
+        if byte + 1 < src.size:
+            chunk |= np.int64(src[byte + 1]) << 8
+        if byte + 2 < src.size:
+            chunk |= np.int64(src[byte + 2])
+        code = (chunk >> (24 - (bitpos & 7) - width)) & ((1 << width) - 1)
+        bitpos += width
+        if code == 257:
+            break
+        if code == 256:
+            width = 9
+            next_code = 258
+            old = -1
+            continue
+        if old == -1:
+            if pos >= dst.size:
+                break
+            dst[pos] = code
+            pos += 1
+            old = code
+            continue
+        if code < next_code:
+            entry = code
+            size = length[code]
+        else:
+            entry = old
+            size = length[old] + 1
+        if pos + size > dst.size:
+            break
+        end = pos + length[entry] - 1
+        while entry >= 0:
+            dst[end] = suffix[entry]
+            entry = prefix[entry]
+            end -= 1
+        if code >= next_code:
+            dst[pos + size - 1] = dst[pos]
+        if next_code < 4096:
+            prefix[next_code] = old
+            suffix[next_code] = dst[pos]
+            length[next_code] = length[old] + 1
+            next_code += 1
+        if next_code + 1 >= (1 << width) and width < 12:
+            width += 1
+        pos += size
+        old = code
+    return pos
+
+
+class Page(object):
+
+    '''
+    the parts of a TIFF image file directory needed to decode its strips
+    '''
+
+    def __init__(self, tags, endian):
+        self.width = int(tags[WIDTH][0])
+        self.length = int(tags[LENGTH][0])
+        self.samples = int(tags.get(SAMPLES, [1])[0])
+        self.bits = int(tags.get(BITS, [1])[0])
+        self.compression = int(tags.get(COMPRESSION, [NONE])[0])
+        self.predictor = int(tags.get(PREDICTOR, [1])[0])
+        self.rows_per_strip = int(min(tags.get(ROWS_PER_STRIP, [self.length])[0], self.length))
+        self.offsets = [int(offset) for offset in tags.get(STRIP_OFFSETS, [])]
+        self.counts = [int(count) for count in tags.get(STRIP_BYTES, [])]
+        kind = SAMPLE_KINDS.get(int(tags.get(SAMPLE_FORMAT, [1])[0]), 'u')
+        if TILE_WIDTH in tags:
+            raise ValueError('tiled TIFF images are not supported')
+        if self.bits % 8 != 0:
+            raise ValueError('TIFF images with %d bit samples are not supported' % self.bits)
+        if self.compression != NONE and self.compression != LZW and self.compression not in DEFLATE:
+            raise ValueError('TIFF compression %d is not supported' % self.compression)
+        if self.predictor not in (1, 2):
+            raise ValueError('TIFF predictor %d is not supported' % self.predictor)
+        self.dtype = np.dtype('%s%s%d' % (endian, kind, self.bits // 8))
+
+    @property
+    def shape(self):
+        if self.samples > 1:
+            return (self.length, self.width, self.samples)
+        return (self.length, self.width)
+
+    def strip_rows(self, strip):
+        start = strip * self.rows_per_strip
+        return start, min(start + self.rows_per_strip, self.length)
+
+    def decode(self, data, strip, out):
+        '''
+        decodes one strip of the page from the mapped file into out
+        '''
+        start, stop = self.strip_rows(strip)
+        rows = out[start:stop].reshape(stop - start, -1)
+        offset, count = self.offsets[strip], self.counts[strip]
+        size = rows.size * self.dtype.itemsize
+        if self.compression == NONE:
+            decoded = np.frombuffer(data, dtype='u1', count=size, offset=offset)
+        elif self.compression == LZW:
+            decoded = np.zeros(size, dtype='u1')
+            lzw_decode(np.frombuffer(data, dtype='u1', count=count, offset=offset), decoded)
+        else:
+            decoded = np.frombuffer(zlib.decompress(data[offset:offset + count]), dtype='u1', count=size)
+        decoded = decoded.view(self.dtype).reshape(rows.shape)
+        if self.predictor == 2:
+            samples = decoded.reshape(stop - start, self.width, self.samples)
+            np.cumsum(samples, axis=1, dtype=self.dtype, out=rows.reshape(samples.shape))
+        else:
+            rows[...] = decoded
+        return out
+
+
+class TiffStack(Stack):
+
+    '''
+    lazy view of a multi-page TIFF movie.  image directories are indexed
+    only as far as the pages asked for, and the strips of the requested
+    pages are decoded across a thread pool
+    '''
+
+    def __init__(self, path, readahead=1, threads=None):
+        self.path = path
+        self.readahead = readahead
+        self.threads = threads or os.cpu_count()
+        self.pool = None
+        with open(path, 'rb') as fd:
+            self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        order = self.data[:2]
+        if order not in (b'II', b'MM'):
+            raise ValueError('file {file!s} is not a TIFF'.format(file=path))
+        self.endian = '<' if order == b'II' else '>'
+        magic, = self.unpack('H', 2)
+        if magic == 42:
+            self.big = False
+            first, = self.unpack('I', 4)
+        elif magic == 43:
+            self.big = True
+            first, = self.unpack('Q', 8)
+        else:
+            raise ValueError('file {file!s} is not a TIFF'.format(file=path))
+        self.pages = []
+        self.next = first
+        page = self.page(0)
+        self.dtype = page.dtype
+        self.page_shape = page.shape
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        return struct.unpack_from(fmt, self.data, offset)
+
+    def read_page(self, offset):
+        if self.big:
+            count, = self.unpack('Q', offset)
+            entry, start, link = 20, offset + 8, 'Q'
+        else:
+            count, = self.unpack('H', offset)
+            entry, start, link = 12, offset + 2, 'I'
+        tags = {}
+        for idx in range(count):
+            pos = start + idx * entry
+            if self.big:
+                tag, kind, values = self.unpack('HHQ', pos)
+                field = pos + 12
+                inline = 8
+            else:
+                tag, kind, values = self.unpack('HHI', pos)
+                field = pos + 8
+                inline = 4
+            if tag not in TAGS or kind not in TYPES:
+                continue
+            if kind in RATIONALS:
+                values *= 2
+            fmt = '%d%s' % (values, TYPES[kind])
+            if struct.calcsize(fmt) > inline:
+                field, = self.unpack(link, field)
+            tags[tag] = self.unpack(fmt, field)
+        nextpos, = self.unpack(link, start + count * entry)
+        return Page(tags, self.endian), nextpos
+
+    def page(self, index):
+        while len(self.pages) <= index and self.next:
+            page, self.next = self.read_page(self.next)
+            self.pages += [page]
+        if index >= len(self.pages):
+            raise IndexError('page %d is out of range for %d pages' % (index, len(self.pages)))
+        return self.pages[index]
+
+    @property
+    def shape(self):
+        while self.next:
+            self.page(len(self.pages))
+        return (len(self.pages),) + self.page_shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        # bounds are checked against the pages parsed so far, only indexing
+        # from the end needs every image directory read
+        key = index[0] if isinstance(index, tuple) else index
+        rest = index[1:] if isinstance(index, tuple) else ()
+        if isinstance(key, (int, np.integer)) and key >= 0:
+            self.page(key)
+            return self.frames(key, key + 1)[(0,) + rest]
+        if isinstance(key, slice) and (key.step or 1) > 0 and (key.start or 0) >= 0 \
+                and key.stop is not None and key.stop >= 0:
+            start, stop = key.start or 0, key.stop
+            while len(self.pages) < stop and self.next:
+                self.page(len(self.pages))
+            stop = min(stop, len(self.pages))
+            return self.frames(start, max(start, stop))[(slice(None, None, key.step),) + rest]
+        return Stack.__getitem__(self, index)
+
+    def frames(self, start, stop):
+        out = np.empty((max(stop - start, 0),) + self.page_shape, dtype=self.dtype)
+        if stop <= start:
+            return out
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.threads)
+        jobs = []
+        for idx in range(start, stop):
+            page = self.page(idx)
+            if page.shape != self.page_shape or page.dtype != self.dtype:
+                raise ValueError('page %d of %s does not match the first page' % (idx, self.path))
+            for strip in range(len(page.offsets)):
+                jobs += [self.pool.submit(page.decode, self.data, strip, out[idx - start])]
+        for job in jobs:
+            job.result()
+        return out
+
+    def prefetch(self, start, stop):
+        if not hasattr(self.data, 'madvise'):
+            return
+        for idx in range(start, stop):
+            page = self.page(idx)
+            for offset, count in zip(page.offsets, page.counts):
+                self.data.madvise(mmap.MADV_WILLNEED, offset - offset % mmap.PAGESIZE,
+                                  count + offset % mmap.PAGESIZE)
+
+
+def load(path, **kwargs):
+    return TiffStack(path, **kwargs)
+
+
+def ifd(entries, next_offset):
+    data = struct.pack('<H', len(entries))
+    for tag, kind, value in sorted(entries):
+        if kind == 3:
+            data += struct.pack('<HHIH2x', tag, kind, 1, value)
+        else:
+            data += struct.pack('<HHII', tag, kind, 1, value)
+    return data + struct.pack('<I', next_offset)
+
+
+def save(image, path, **kwargs):
+    '''
+    writes a 2D image or a stack as an uncompressed multi-page TIFF
+    '''
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[np.newaxis]
+    dtype = image.dtype.newbyteorder('<')
+    formats = {'u': 1, 'i': 2, 'f': 3}
+    if dtype.kind not in formats:
+        raise ValueError('can not save %s data as TIFF' % dtype)
+    count, rows, cols = image.shape
+    size = rows * cols * dtype.itemsize
+    with open(path, 'wb') as dst:
+        dst.write(b'II' + struct.pack('<HI', 42, 8))
+        for idx, frame in enumerate(image):
+            offset = dst.tell()
+            entries = 10
+            data_offset = offset + 2 + entries * 12 + 4
+            next_offset = data_offset + size if idx + 1 < count else 0
+            dst.write(ifd([
+                (WIDTH, 4, cols),
+                (LENGTH, 4, rows),
+                (BITS, 3, dtype.itemsize * 8),
+                (COMPRESSION, 3, NONE),
+                (PHOTOMETRIC, 3, 1),
+                (STRIP_OFFSETS, 4, data_offset),
+                (SAMPLES, 3, 1),
+                (ROWS_PER_STRIP, 4, rows),
+                (STRIP_BYTES, 4, size),
+                (SAMPLE_FORMAT, 3, formats[dtype.kind]),
+            ], next_offset))
+            frame.astype(dtype, copy=False).tofile(dst)
+    return path
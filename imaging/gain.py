@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+
+import os
+from functools import reduce, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as nd
+
+import pyfs
+from imaging.formats import FORMATS, load
+
+
+def load_defects(path, shape):
+    '''
+    reads a SerialEM/DM camera defects list, or a defect mask image, into a
+    boolean mask of the given frame shape.  defects listed at the camera size
+    are scaled up for super-resolution frames
+    '''
+    if pyfs.gext(path, last=True) not in (None, 'txt'):
+        return np.asarray(load(path)).reshape(shape) != 0
+    entries = {}
+    with open(path) as src:
+        for line in src:
+            fields = line.split()
+            try:
+                values = [int(value) for value in fields[1:]]
+            except ValueError:
+                continue
+            if fields:
+                entries.setdefault(fields[0], []).append(values)
+    size = (entries.get('CameraSizeY', [[shape[0]]])[0][0],
+            entries.get('CameraSizeX', [[shape[1]]])[0][0])
+    mask = np.zeros(size, dtype=bool)
+    for values in entries.get('BadColumns', []):
+        mask[:, values] = True
+    for values in entries.get('BadRows', []):
+        mask[values, :] = True
+    for col, start, stop in entries.get('PartialBadCol', []):
+        mask[start:stop + 1, col] = True
+    for row, start, stop in entries.get('PartialBadRow', []):
+        mask[row, start:stop + 1] = True
+    for values in entries.get('BadPixels', []):
+        for col, row in zip(values[0::2], values[1::2]):
+            mask[row, col] = True
+    factor = shape[0] // size[0]
+    if factor > 1 and shape == (size[0] * factor, size[1] * factor):
+        mask = np.repeat(np.repeat(mask, factor, axis=0), factor, axis=1)
+    if mask.shape != tuple(shape):
+        raise ValueError('defects for a %s camera do not match %s frames' % (size, shape))
+    return mask
+
+
+def orient(image, rotate=0, flip=0):
+    '''
+    rotates by `rotate` quarter turns then flips: 1 upside down, 2 left to right
+    '''
+    image = np.rot90(image, rotate)
+    if flip == 1:
+        image = image[::-1, :]
+    elif flip == 2:
+        image = image[:, ::-1]
+    return np.ascontiguousarray(image)
+
+
+class Gain(object):
+
+    '''
+    a prepared gain reference and defect map.  the reference and defects
+    are loaded, oriented and inverted once, then applied to chunks of frames
+    by multiplying with the gain and replacing each defect with its nearest
+    good pixel
+    '''
+
+    def __init__(self, norm=None, defects=None, invert=False, rotate=0, flip=0, scale=1.0, shape=None):
+        self.gain = None
+        self.scale = np.float32(scale)
+        if norm is not None:
+            gain = np.array(load(norm), dtype='f4')
+            gain = gain.reshape(gain.shape[-2:])
+            if invert:
+                gain = np.divide(1.0, gain, out=np.zeros_like(gain), where=gain != 0)
+            self.gain = orient(gain, rotate, flip) * np.float32(scale)
+            shape = self.gain.shape
+        self.targets = self.sources = None
+        if defects is not None:
+            if shape is None:
+                raise ValueError('frame shape is needed to apply defects without a gain reference')
+            camera = tuple(shape) if rotate % 2 == 0 else tuple(shape[::-1])
+            mask = orient(load_defects(defects, camera), rotate, flip)
+            nearest = nd.distance_transform_edt(mask, return_distances=False, return_indices=True)
+            self.targets = np.flatnonzero(mask)
+            self.sources = np.ravel_multi_index(tuple(idx.flat[self.targets] for idx in nearest), mask.shape)
+
+    def apply(self, frames, out=None):
+        frames = np.asarray(frames)
+        if out is None:
+            out = np.empty(frames.shape, dtype='f4')
+        if self.gain is not None:
+            np.multiply(frames, self.gain, out=out, casting='unsafe')
+        elif self.scale != 1:
+            # without a reference the scale is not folded into the gain
+            np.multiply(frames, self.scale, out=out, casting='unsafe')
+        else:
+            out[...] = frames
+        if self.targets is not None:
+            flat = out.reshape(out.shape[:-2] + (-1,))
+            flat[..., self.targets] = flat[..., self.sources]
+        return out
+
+    def normalize(self, src, dst, dtype='f4', threads=None, chunk=4):
+        '''
+        applies the gain to every frame of an MRC stack, chunks of frames are
+        processed on a thread pool and written to a memory mapped stack
+        '''
+        mrc = FORMATS['mrc']
+        threads = threads or os.cpu_count()
+        dtype = np.dtype(dtype)
+        stack = mrc.MrcStack(src, mode='r')
+        header = mrc.header_like(stack, dtype)
+        dst_data = np.memmap(dst, mode='w+', dtype=dtype,
+                             offset=mrc.MRCHeader.itemsize, shape=stack.shape)
+
+        def normalize_chunk(start):
+            stop = min(start + chunk, len(stack))
+            normed = self.apply(stack.frames(start, stop))
+            if dtype.kind in 'ui':
+                info = np.iinfo(dtype)
+                np.rint(normed, out=normed)
+                np.clip(normed, info.min, info.max, out=normed)
+            dst_data[start:stop] = normed
+            return mrc.Moments.of(dst_data[start:stop])
+
+        with ThreadPoolExecutor(threads) as pool:
+            total = reduce(mrc.Moments.merge, pool.map(normalize_chunk, range(0, len(stack), chunk)), mrc.Moments())
+        dst_data.flush()
+        del dst_data
+        total.fill(header[0])
+        with open(dst, 'r+b') as fd:
+            header.tofile(fd)
+        return dst
+
+
+@lru_cache(maxsize=4)
+def prepare(norm=None, defects=None, invert=False, rotate=0, flip=0, scale=1.0, shape=None):
+    '''
+    prepared gains are kept around so a worker reuses them across movies
+    '''
+    return Gain(norm, defects, invert, rotate, flip, scale, shape)
+
+
+def normalize(src, norm, dst, invert=False, defects=None, rotate=0, flip=0, scale=1.0, dtype='f4', threads=None):
+    shape = None
+    if norm is None:
+        shape = FORMATS['mrc'].MrcStack(src).frame_shape
+    gain = prepare(norm, defects, invert, rotate, flip, scale, shape)
+    return gain.normalize(src, dst, dtype=dtype, threads=threads)
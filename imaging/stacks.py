@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+# frames per chunk when iterating over a stack
+CHUNK_FRAMES = 8
+
+
+class Stack(object):
+
+    '''
+    base for lazily loaded image stacks.  subclasses set `shape` and `dtype`
+    and provide `frames(start, stop)`, this adds numpy style indexing and
+    chunked iteration with a `prefetch(start, stop)` hook for readahead
+    '''
+
+    readahead = 1
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def frame_shape(self):
+        return self.shape[1:]
+
+    def frames(self, start, stop):
+        raise NotImplementedError
+
+    def prefetch(self, start, stop):
+        pass
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(self)))
+            if len(indices) == 0:
+                return self.frames(0, 0)[(slice(None),) + rest]
+            lo, hi = min(indices), max(indices) + 1
+            return self.frames(lo, hi)[(slice(None, None, index.step),) + rest]
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('frame %d is out of range for %d frames' % (index, len(self)))
+            return self.frames(index, index + 1)[(0,) + rest]
+        return self.frames(0, len(self))[(index,) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.frames(0, len(self))
+        if dtype is not None:
+            return data.astype(dtype)
+        return data
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for frame in chunk:
+                yield frame
+
+    def chunks(self, size=CHUNK_FRAMES, readahead=None):
+        '''
+        iterates over the stack `size` frames at a time, prefetching the
+        next `readahead` chunks
+        '''
+        if readahead is None:
+            readahead = self.readahead
+        for start in range(0, len(self), size):
+            stop = min(start + size, len(self))
+            self.prefetch(stop, min(stop + size * readahead, len(self)))
+            yield self.frames(start, stop)
@@ -65,20 +65,21 @@ def get_arguments():
   return parser.parse_args()
 
 
-def calculate_dose(mrcpath, apix, correction=1.0):
-  mean = imaging.FORMATS['mrc'].load_header(mrcpath)['mean']
+def calculate_dose(header, apix, correction=1.0):
+  mean = header['mean']
   if mean <= 0.0:
     return correction
   return correction * (mean / (apix*apix))
 
 
-def calculate_grouping(mrcpath, grouping):
-  header = imaging.FORMATS['mrc'].load_header(mrcpath)
+def calculate_grouping(header, grouping):
   return min(7, math.ceil( grouping / header['mean']))
 
 
-def motioncor2(src, dst, args, gpu=0):
+def motioncor2(src, dst, args, gpu=0, header=None):
   print('processing: %s'%(src))
+  if header is None:
+    header = imaging.FORMATS['mrc'].load_header(src)
   cmd  = ['motioncor2']
   if src.endswith('.mrc') or src.endswith('.mrcs'):
     cmd += ['-InMrc', src]
@@ -108,10 +109,10 @@ def motioncor2(src, dst, args, gpu=0):
   if args.truncate:
     cmd += ['-Trunc', args.truncate]
   if args.correction is not None:
-    expf = calculate_dose(src, args.apix, args.correction)
+    expf = calculate_dose(header, args.apix, args.correction)
     print('using dose rate: %f e-/A^2/frame'%(expf))
     cmd += ['-FmDose', expf]
-  group = calculate_grouping(src, args.group)
+  group = calculate_grouping(header, args.group)
   cmd += ['-Group', args.group]
   if args.rotgain:
     cmd += ['-RotGain', 3, '-FlipGain', 1]
@@ -132,7 +133,7 @@ def pbunzip2(src, dst):
   return dst
 
 
-def process(path, aligned, args, gpu):
+def process(path, aligned, args, gpu, header=None):
   
   t0 = time.time()
   
@@ -158,7 +159,7 @@ def process(path, aligned, args, gpu):
     motioncor2(tmp_unpacked, tmp_aligned, args, gpu=gpu)
   else:
     args.mocor2_norm = args.norm
-    motioncor2(tmp_unzipped, tmp_aligned, args, gpu=gpu)  
+    motioncor2(tmp_unzipped, tmp_aligned, args, gpu=gpu, header=header)  
 
   mv(tmp_aligned, aligned)
   mv(tmp_aligned_dw, aligned_dw)
@@ -184,10 +185,10 @@ def label(path, label):
 
 def workerit(queue, args, gpuid):
   while True:
-    src, dst = queue.get()
+    src, dst, header = queue.get()
     if src is None:
       return
-    process(src, dst, args, gpuid)
+    process(src, dst, args, gpuid, header)
     queue.task_done()
 
 
@@ -203,7 +204,8 @@ def main():
   #results = []  
   #
   #gpu = 0
-  for path in args.mrcs:
+  headers = imaging.FORMATS['mrc'].scan(args.mrcs)
+  for path, entry in zip(args.mrcs, headers):
     dst = label(path, args.label)
     if pyfs.exists(dst):
       print(dst, 'exists, skipping', path)
@@ -215,14 +217,15 @@ def main():
     #process(path, dst, args, gpu % args.gpus)
     #results += [pool.apply_async(process, args=(path, dst, args, gpu % args.gpus))]
     #gpu += 1
-    queue.put((path, dst))
+    header = entry['header'] if entry['valid'] else None
+    queue.put((path, dst, header))
   #pool.close()
   #for result in results:
     #print(result.get())
   #pool.join()
   queue.join()
   for worker in workers:
-    queue.put((None, None))
+    queue.put((None, None, None))
     
 
 
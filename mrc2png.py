@@ -18,26 +18,73 @@ def get_arguments():
   parser.add_argument('-i', '--pattern', required=True, nargs='+',  help='images to convert')
   parser.add_argument('-s', '--scale', type=float, default=1.0, help='scaling for saving image')
   parser.add_argument('-f', '--force', action='store_true', help='force overwriting of images')
+  parser.add_argument('-p', '--processes', type=int, default=1, help='number of images to convert in parallel')
+  parser.add_argument('--method', choices=['exact', 'histogram', 'subsample'], default='subsample',
+                      help='how the contrast limits are found, subsample is the fastest')
+  parser.add_argument('--power', type=int, default=0, metavar='SIZE',
+                      help='also write a power spectrum thumbnail averaged over overlapping SIZE x SIZE tiles')
   return parser.parse_args()
 
 
-def topng(mrc, scale, force):
+def thumbnail(image, scale, method='subsample'):
+  '''
+  downsamples by summing whole blocks of pixels, only a fractional remainder
+  of the scale is interpolated, then stretches the contrast to bytes using
+  limits taken from a random subsample of the pixels rather than a sort
+  '''
+  factor = int(1.0 / scale) if scale < 1.0 else 1
+  if factor > 1:
+    image = imaging.filters.bin(image, factor)
+    scale = scale * factor
+  if abs(scale - 1.0) > 1e-3:
+    image = imaging.filters.zoom(np.asarray(image, dtype='f4'), scale)
+  return imaging.filters.norm(image, 0.01, 0.01, 0, 255, method=method).astype('u1')
+
+
+def power_spectrum(image, size, method='subsample'):
+  '''
+  log of the welch averaged power spectrum over size x size tiles of an image
+  '''
+  if min(image.shape) < size:
+    return None
+  spectrum, _ = imaging.fft.periodogram(image, size)
+  power = np.log1p(spectrum)
+  return imaging.filters.norm(power, 0.01, 0.001, 0, 255, method=method).astype('u1')
+
+
+def topng(mrc, scale, force, method='subsample', power=0):
   png = pyfs.rext(mrc, 'png')
   png = mrc + '.png'
   if not force and pyfs.exists(png):
     return
-  print(mrc, '->', png)
-  image = imaging.load(mrc)[0]
-  image = imaging.filters.zoom(image, scale)
-  imaging.save(image, png)
+  image = imaging.FORMATS['mrc'].MrcStack(mrc)[0]
+  imaging.save(thumbnail(image, scale, method), png, norm=None)
+  if power:
+    spectrum = power_spectrum(image, power, method)
+    if spectrum is not None:
+      imaging.save(spectrum, mrc + '.ps.png', norm=None)
+  return png
+
+
+def convert(args):
+  mrc, scale, force, method, power = args
+  return mrc, topng(mrc, scale, force, method, power)
 
 
 if __name__ == '__main__':
   args = get_arguments()
   #mrcs = list(glob.glob(args.pattern))
-  for mrc in args.pattern:
-    topng(mrc, args.scale, args.force)
-
-
-
-
+  jobs = [(mrc, args.scale, args.force, args.method, args.power) for mrc in args.pattern]
+  pool = None
+  if args.processes > 1:
+    import multiprocessing as mp
+    pool = mp.Pool(args.processes)
+    results = pool.imap_unordered(convert, jobs)
+  else:
+    results = map(convert, jobs)
+  for mrc, png in results:
+    if png:
+      print(mrc, '->', png)
+  if pool is not None:
+    pool.close()
+    pool.join()
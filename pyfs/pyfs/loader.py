@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
+import ast
 import imp
+import threading
 
 from .glob import glob
 from .cmds import join, rext, bname
@@ -10,28 +12,80 @@ def loader(path):
     return Plugins(path)
 
 
+def names(path):
+    '''
+    reads the NAMES list of a plugin from its source without importing it
+    '''
+    with open(path) as src:
+        tree = ast.parse(src.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == "NAMES":
+                    return list(ast.literal_eval(node.value))
+    return []
+
+
 class Plugins(object):
 
+    '''
+    registry of the plugin modules in a directory, keyed by the names each
+    module lists in NAMES.  the directory is scanned once, reading NAMES
+    from the source, and a module is only imported the first time one of
+    its names is looked up.  modules from elsewhere can be registered too
+    '''
+
     def __init__(self, path):
         self.__path = path
+        self.__paths = None
+        self.__modules = {}
+        self.__imported = {}
+        self.__lock = threading.RLock()
 
-    def __reload(self):
-        loaded = {}
-        for path in glob(join(self.__path, "*.py")):
-            module_name = rext(bname(path))
-            module = imp.load_source(module_name, path)
-            for ext in getattr(module, "NAMES", []):
-                setattr(self, ext, module)
-                loaded[ext] = module
-        return loaded
+    def __scan(self):
+        if self.__paths is None:
+            paths = {}
+            for path in sorted(glob(join(self.__path, "*.py"))):
+                for name in names(path):
+                    paths[name] = path
+            self.__paths = paths
+        return self.__paths
 
-    def __getattr__(self, key):
-        return self.__reload()[key]
+    def __import(self, path):
+        with self.__lock:
+            if path not in self.__imported:
+                self.__imported[path] = imp.load_source(rext(bname(path)), path)
+            return self.__imported[path]
+
+    def register(self, module, names=None):
+        if names is None:
+            names = getattr(module, "NAMES", [])
+        for name in names:
+            self.__modules[name] = module
+        return module
+
+    def names(self):
+        return sorted(set(self.__modules) | set(self.__scan()))
 
     def __getitem__(self, key):
-        return getattr(self, key)
+        try:
+            return self.__modules[key]
+        except KeyError:
+            pass
+        module = self.__import(self.__scan()[key])
+        for name in getattr(module, "NAMES", []):
+            self.__modules.setdefault(name, module)
+        return self.__modules.setdefault(key, module)
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
 
     def __contains__(self, key):
         if not isinstance(key, str):
             return False
-        return hasattr(self, key)
+        return key in self.__modules or key in self.__scan()
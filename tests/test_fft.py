@@ -0,0 +1,32 @@
+import numpy as np
+
+from imaging import fft
+
+
+def test_cache_misses_after_in_place_edit():
+    image = np.random.default_rng(0).normal(size=(1024, 1024)).astype('f4')
+    before = fft.rfft(image)
+    image[500:510, 500:510] += 1.0
+    after = fft.rfft(image)
+    assert not np.allclose(before, after)
+    assert np.allclose(after, np.fft.rfftn(image), atol=1e-2)
+
+
+def test_cache_misses_for_reused_sparse_buffer():
+    rng = np.random.default_rng(1)
+    frame = np.zeros((2048, 2048), dtype='f4')
+    transforms = []
+    for _ in range(2):
+        frame[...] = 0.0
+        frame.flat[rng.choice(frame.size, 50, replace=False)] = 1.0
+        transforms += [fft.rfft(frame)]
+    assert not np.allclose(transforms[0], transforms[1])
+    assert np.allclose(transforms[1], np.fft.rfftn(frame), atol=1e-3)
+
+
+def test_cache_hits_equal_copies():
+    image = np.random.default_rng(2).normal(size=(256, 256)).astype('f4')
+    first = fft.rfft(image)
+    hits = fft.cache.stats()['hits']
+    assert fft.rfft(image.copy()) is first
+    assert fft.cache.stats()['hits'] == hits + 1
@@ -0,0 +1,27 @@
+import numpy as np
+
+from imaging import filters
+
+
+def test_histogram_matches_numpy():
+    image = np.random.default_rng(0).normal(size=(300, 400))
+    counts, centers = filters.histogram(image, 64, chunk=1000)
+    expected, edges = np.histogram(image, 64, (image.min(), image.max()))
+    assert np.array_equal(counts, expected)
+    assert np.allclose(centers, (edges[:-1] + edges[1:]) / 2.0)
+
+
+def test_histogram_counts_narrow_integers_exactly():
+    image = np.random.default_rng(1).poisson(30, size=(200, 200)).astype('u1')
+    counts, centers = filters.histogram(image)
+    values, expected = np.unique(image, return_counts=True)
+    assert np.array_equal(centers[counts > 0], values)
+    assert np.array_equal(counts[counts > 0], expected)
+
+
+def test_histogram_band_stats_close_to_exact():
+    image = np.random.default_rng(2).normal(size=(512, 512)).astype('f4')
+    bands = [(0, image.size // 100), (image.size - image.size // 100, image.size)]
+    exact = filters.band_stats(image, bands, 'exact')
+    approximate = filters.band_stats(image, bands, 'histogram')
+    assert np.allclose(exact, approximate, atol=1e-2)
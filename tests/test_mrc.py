@@ -0,0 +1,24 @@
+import numpy as np
+
+import imaging
+
+
+def write_big_endian(path, data):
+    mrc = imaging.FORMATS['mrc']
+    header = mrc.header_from_array(data)
+    with open(path, 'wb') as dst:
+        header.astype(header.dtype.newbyteorder('>')).tofile(dst)
+        data.astype('>f4').tofile(dst)
+
+
+def test_big_endian_round_trip(tmp_path):
+    mrc = imaging.FORMATS['mrc']
+    data = np.random.default_rng(0).normal(size=(3, 16, 24)).astype('f4')
+    src, dst = str(tmp_path / 'be.mrc'), str(tmp_path / 'out.mrc')
+    write_big_endian(src, data)
+    loaded = mrc.load(src)
+    assert loaded.dtype.byteorder == '>'
+    mrc.save(loaded, dst)
+    saved = mrc.MrcStack(dst)
+    np.testing.assert_array_equal(saved[:], data)
+    assert np.isclose(saved.header['mean'], data.mean(), atol=1e-5)
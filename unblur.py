@@ -9,7 +9,7 @@ import socket
 >>>>>>> 498c0a075196c556752da81fa0913456d52b35ab
 
 import numpy as np
-from normalize import normalize
+from imaging.gain import normalize
 
 def bunzip2(srcpath, dstpath):
     if os.system('pbunzip2 -p8 -kc %s > %s' % (srcpath, dstpath)) != 0:
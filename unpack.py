@@ -2,10 +2,12 @@
 
 import os
 import pyfs
+import imaging
+import imaging.gain
 
 MODES = { 
-  'byte'  : 'ubyte',
-  'float' : 2
+  'byte'  : 'u1',
+  'float' : 'f4'
 }
 
 MODE_SCALING = {
@@ -41,36 +43,19 @@ def get_arguments():
 
 def unpack(srcmrc, dstmrc, defects=None, norm=None, mode='byte'):
   tmpmrc = dstmrc + '.tmp.mrc'
-  cmd = ['clip', 'unpack']
-  cmd += ['-n', MODE_SCALING[mode]]
-  cmd += ['-m', MODES[mode]]
-  if defects is not None:
-    cmd += ['-D', defects, '-S']
-  cmd += [srcmrc]
-  if norm is not None:
-    cmd += [norm]
-  cmd += [tmpmrc]
-  cmd = ' '.join([str(x) for x in cmd])
-  print(cmd)
-  os.system(cmd)
+  if defects is None and norm is None:
+    imaging.FORMATS['mrc'].unpack(srcmrc, tmpmrc, dtype=MODES[mode], scale=MODE_SCALING[mode])
+  else:
+    imaging.gain.normalize(srcmrc, norm, tmpmrc, defects=defects,
+                           scale=MODE_SCALING[mode], dtype=MODES[mode])
   os.rename(tmpmrc, dstmrc)
   print(srcmrc, '->', dstmrc)
 
 
 def normalize(srcmrc, dstmrc, defects=None, norm=None, mode='byte'):
   tmpmrc = dstmrc + '.tmp.mrc'
-  cmd = ['clip', 'mult']
-  cmd += ['-n', MODE_SCALING[mode]]
-  cmd += ['-m', MODES[mode]]
-  if defects is not None:
-    cmd += ['-D', defects, '-S']
-  cmd += [srcmrc]
-  if norm is not None:
-    cmd += [norm]
-  cmd += [tmpmrc]
-  cmd = ' '.join([str(x) for x in cmd])
-  print(cmd)
-  os.system(cmd)
+  imaging.gain.normalize(srcmrc, norm, tmpmrc, defects=defects,
+                         scale=MODE_SCALING[mode], dtype=MODES[mode])
   os.rename(tmpmrc, dstmrc)
   print(srcmrc, '->', dstmrc)  
 